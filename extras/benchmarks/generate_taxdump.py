@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+"""
+Write a synthetic NCBI taxdump and dataset mapping files for benchmarking.
+
+The output directory gets nodes.dmp, names.dmp, merged.dmp, delnodes.dmp, a
+BUSCO placement file (busco_placement.txt.tar.gz), an Augustus mapping
+(augustus_mapping.tsv) and a list of query taxids (taxids.txt), in the same
+formats as the real reference data.
+
+Tree shapes:
+    random    each node is attached to a random recent node, which gives a
+              mix of deep and bushy clades, like the NCBI taxonomy
+    balanced  every internal node has --branching children
+    deep      long chains with occasional side branches
+"""
+
+import argparse
+import io
+import json
+import random
+import tarfile
+from pathlib import Path
+
+RANKS = [
+    "superkingdom",
+    "kingdom",
+    "phylum",
+    "class",
+    "order",
+    "family",
+    "genus",
+    "species",
+    "subspecies",
+]
+
+GENETIC_CODES = [1, 1, 1, 1, 4, 6, 11]
+MITO_CODES = [0, 1, 2, 2, 4, 5, 9]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+
+    parser.add_argument("outdir", type=Path, help="Directory to write the files to")
+    parser.add_argument(
+        "--n_taxa", type=int, help="Number of nodes in the tree", default=100000
+    )
+    parser.add_argument(
+        "--shape",
+        choices=["random", "balanced", "deep"],
+        help="Shape of the tree",
+        default="random",
+    )
+    parser.add_argument(
+        "--branching",
+        type=int,
+        help="Children per internal node for --shape balanced",
+        default=4,
+    )
+    parser.add_argument(
+        "--busco_datasets",
+        type=int,
+        help="Number of taxids in the BUSCO placement file",
+        default=300,
+    )
+    parser.add_argument(
+        "--augustus_datasets",
+        type=int,
+        help="Number of taxids in the Augustus mapping",
+        default=100,
+    )
+    parser.add_argument(
+        "--n_queries", type=int, help="Number of taxids in taxids.txt", default=10000
+    )
+    parser.add_argument("--seed", type=int, help="Random seed", default=1)
+
+    return parser.parse_args()
+
+
+def generate_parents(n_taxa, shape, branching, rng):
+    """
+    Return a list of (taxid, parent_taxid) in an order where every parent
+    comes before its children. Taxid 1 is the root. Taxids are not
+    contiguous, as in the NCBI taxonomy.
+    """
+    edges = [(1, 1)]
+    taxids = [1]
+    next_taxid = 2
+    for i in range(1, n_taxa):
+        if shape == "balanced":
+            parent = taxids[(i - 1) // branching]
+        elif shape == "deep":
+            parent = taxids[-1] if rng.random() < 0.9 else rng.choice(taxids)
+        else:
+            parent = rng.choice(taxids[-200:] if rng.random() < 0.7 else taxids)
+        edges.append((next_taxid, parent))
+        taxids.append(next_taxid)
+        next_taxid += rng.choice([1, 1, 1, 2, 7])
+    return edges
+
+
+def write_nodes(file_path, edges, rng):
+    depth = {}
+    with open(file_path, "wt") as f:
+        for taxid, parent in edges:
+            depth[taxid] = 0 if taxid == parent else depth[parent] + 1
+            rank = "no rank"
+            if taxid != parent and rng.random() < 0.8:
+                rank = RANKS[min(depth[taxid], len(RANKS)) - 1]
+            fields = [
+                taxid,
+                parent,
+                rank,
+                "",
+                0,
+                1,
+                rng.choice(GENETIC_CODES),
+                1,
+                rng.choice(MITO_CODES),
+                1,
+                0,
+                0,
+                "",
+                0,
+                0,
+                0,
+                0,
+                0,
+            ]
+            f.write("\t|\t".join(str(x) for x in fields) + "\t|\n")
+
+
+def write_names(file_path, edges, rng):
+    with open(file_path, "wt") as f:
+        for taxid, _ in edges:
+            f.write(f"{taxid}\t|\tTaxon {taxid}\t|\t\t|\tscientific name\t|\n")
+            if rng.random() < 0.1:
+                f.write(f"{taxid}\t|\tTaxon alias {taxid}\t|\t\t|\tsynonym\t|\n")
+
+
+def write_merged_and_delnodes(outdir, edges, rng):
+    """Use some of the gaps between taxids as merged and deleted taxids."""
+    taxids = [taxid for taxid, _ in edges]
+    gaps = [
+        x
+        for previous, taxid in zip(taxids, taxids[1:])
+        for x in range(previous + 1, taxid)
+    ]
+    rng.shuffle(gaps)
+    n = len(gaps) // 4
+    with open(Path(outdir, "merged.dmp"), "wt") as f:
+        for taxid in sorted(gaps[:n]):
+            f.write(f"{taxid}\t|\t{rng.choice(taxids)}\t|\n")
+    with open(Path(outdir, "delnodes.dmp"), "wt") as f:
+        for taxid in sorted(gaps[n : 2 * n]):
+            f.write(f"{taxid}\t|\n")
+
+
+def write_busco_placement(file_path, internal_taxids, n_datasets, rng):
+    taxids = rng.sample(internal_taxids, min(n_datasets, len(internal_taxids)))
+    data = "#taxid\tbusco_lineage\n" + "".join(
+        f"{taxid}\tlineage_{taxid}_odb10\n" for taxid in taxids
+    )
+    data = data.encode()
+    member = tarfile.TarInfo("mapping_taxids-busco_dataset_name.txt")
+    member.size = len(data)
+    with tarfile.open(file_path, "w:gz") as tar:
+        tar.addfile(member, io.BytesIO(data))
+    return taxids
+
+
+def write_augustus_mapping(file_path, internal_taxids, n_datasets, rng):
+    taxids = rng.sample(internal_taxids, min(n_datasets, len(internal_taxids)))
+    with open(file_path, "wt") as f:
+        for taxid in taxids:
+            f.write(f"{taxid}\tspecies_{taxid}\n")
+    return taxids
+
+
+def write_queries(file_path, edges, n_queries, rng):
+    taxids = [taxid for taxid, _ in edges]
+    with open(file_path, "wt") as f:
+        for _ in range(n_queries):
+            f.write(f"{rng.choice(taxids)}\n")
+
+
+def main():
+    args = parse_arguments()
+    rng = random.Random(args.seed)
+    args.outdir.mkdir(parents=True, exist_ok=True)
+
+    edges = generate_parents(args.n_taxa, args.shape, args.branching, rng)
+    internal_taxids = sorted({parent for taxid, parent in edges if taxid != 1})
+
+    write_nodes(Path(args.outdir, "nodes.dmp"), edges, rng)
+    write_names(Path(args.outdir, "names.dmp"), edges, rng)
+    write_merged_and_delnodes(args.outdir, edges, rng)
+    write_busco_placement(
+        Path(args.outdir, "busco_placement.txt.tar.gz"),
+        internal_taxids,
+        args.busco_datasets,
+        rng,
+    )
+    write_augustus_mapping(
+        Path(args.outdir, "augustus_mapping.tsv"),
+        internal_taxids,
+        args.augustus_datasets,
+        rng,
+    )
+    write_queries(Path(args.outdir, "taxids.txt"), edges, args.n_queries, rng)
+
+    # Record how the data were generated, so benchmark results can say what
+    # they were run on.
+    parameters = {k: v for k, v in vars(args).items() if k != "outdir"}
+    with open(Path(args.outdir, "parameters.json"), "wt") as f:
+        json.dump(parameters, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
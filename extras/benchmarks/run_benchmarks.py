@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark TaxdumpTree on a synthetic taxdump from generate_taxdump.py.
+
+Each benchmark runs in its own Python process, so that import time, the page
+cache and peak RSS of one benchmark don't leak into the next. The results are
+written as JSON, so runs from different releases can be compared.
+
+    python3 extras/benchmarks/generate_taxdump.py test-output/synthetic
+    python3 extras/benchmarks/run_benchmarks.py test-output/synthetic \\
+        --output test-output/benchmarks.json
+"""
+
+import argparse
+import json
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+
+# Benchmarks in the order they are run. cold_build must run first, because
+# the others use the cache it writes.
+BENCHMARKS = [
+    "cold_build",
+    "warm_load",
+    "single_query",
+    "batch_10k",
+    "batch_1m",
+]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+
+    parser.add_argument(
+        "data_dir", type=Path, help="Directory written by generate_taxdump.py"
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        help="File to write the results to. Defaults to Standard Output.",
+    )
+    parser.add_argument(
+        "--benchmarks",
+        nargs="+",
+        choices=BENCHMARKS,
+        help="Benchmarks to run. Defaults to all of them.",
+        default=BENCHMARKS,
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        help="Number of times to repeat each timed section. The best is kept.",
+        default=3,
+    )
+    parser.add_argument("--seed", type=int, help="Random seed", default=1)
+
+    # Used to run a single benchmark in a subprocess.
+    parser.add_argument("--run_one", choices=BENCHMARKS, help=argparse.SUPPRESS)
+    parser.add_argument("--cache_dir", type=Path, help=argparse.SUPPRESS)
+
+    return parser.parse_args()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def best_time(function, repeats):
+    """Call function repeats times and return the shortest wall time."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def load_taxdump_tree(data_dir, cache_dir):
+    from atol_reference_data_lookups.taxdump_tree import TaxdumpTree
+
+    return TaxdumpTree(
+        Path(data_dir, "nodes.dmp"),
+        Path(data_dir, "names.dmp"),
+        Path(data_dir, "busco_placement.txt.tar.gz"),
+        Path(data_dir, "augustus_mapping.tsv"),
+        cache_dir,
+        merged_file=Path(data_dir, "merged.dmp"),
+        delnodes_file=Path(data_dir, "delnodes.dmp"),
+    )
+
+
+def random_taxids(taxdump_tree, n, seed):
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    return rng.choice(taxdump_tree.index.taxids, size=n)
+
+
+def batch_lookup(taxdump_tree, taxids, repeats):
+    """Time a batch lookup, including turning the results into records."""
+
+    def run():
+        for _ in taxdump_tree.lookup_many(taxids).records():
+            pass
+
+    seconds = best_time(run, repeats)
+    return {
+        "n_queries": len(taxids),
+        "seconds": seconds,
+        "queries_per_second": len(taxids) / seconds,
+    }
+
+
+def run_benchmark(name, data_dir, cache_dir, repeats, seed):
+    if name == "cold_build":
+        start = time.perf_counter()
+        taxdump_tree = load_taxdump_tree(data_dir, cache_dir)
+        result = {
+            "seconds": time.perf_counter() - start,
+            "n_taxa": len(taxdump_tree.index),
+        }
+
+    elif name == "warm_load":
+        start = time.perf_counter()
+        load_taxdump_tree(data_dir, cache_dir)
+        result = {"seconds": time.perf_counter() - start}
+
+    elif name == "single_query":
+        taxdump_tree = load_taxdump_tree(data_dir, cache_dir)
+        taxids = random_taxids(taxdump_tree, 1000, seed).tolist()
+        latencies = []
+        for taxid in taxids:
+            start = time.perf_counter()
+            dict(taxdump_tree.lookup_many([taxid]).records())
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        result = {
+            "n_queries": len(latencies),
+            "median_us": latencies[len(latencies) // 2] * 1e6,
+            "p99_us": latencies[int(len(latencies) * 0.99)] * 1e6,
+        }
+
+    elif name == "batch_10k":
+        taxdump_tree = load_taxdump_tree(data_dir, cache_dir)
+        taxids = random_taxids(taxdump_tree, 10_000, seed)
+        result = batch_lookup(taxdump_tree, taxids, repeats)
+
+    elif name == "batch_1m":
+        taxdump_tree = load_taxdump_tree(data_dir, cache_dir)
+        taxids = random_taxids(taxdump_tree, 1_000_000, seed)
+        result = batch_lookup(taxdump_tree, taxids, repeats)
+
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def run_in_subprocess(name, args, cache_dir):
+    command = [
+        sys.executable,
+        __file__,
+        str(args.data_dir),
+        "--run_one",
+        name,
+        "--cache_dir",
+        str(cache_dir),
+        "--repeats",
+        str(args.repeats),
+        "--seed",
+        str(args.seed),
+    ]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr)
+        raise RuntimeError(f"Benchmark {name} failed")
+    return json.loads(result.stdout)
+
+
+def get_package_version():
+    try:
+        return version("atol-reference-data-lookups")
+    except PackageNotFoundError:
+        return None
+
+
+def main():
+    args = parse_arguments()
+
+    if args.run_one is not None:
+        from atol_reference_data_lookups import setup_logger
+
+        setup_logger("WARNING")
+        result = run_benchmark(
+            args.run_one, args.data_dir, args.cache_dir, args.repeats, args.seed
+        )
+        json.dump(result, sys.stdout)
+        return
+
+    parameters_file = Path(args.data_dir, "parameters.json")
+    results = {
+        "package_version": get_package_version(),
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "data": (
+            json.loads(parameters_file.read_text())
+            if parameters_file.exists()
+            else None
+        ),
+        "benchmarks": {},
+    }
+
+    cache_dir = Path(tempfile.mkdtemp(prefix="atol_benchmark_cache_"))
+    try:
+        for name in BENCHMARKS:
+            if name not in args.benchmarks and name != "cold_build":
+                continue
+            print(f"Running {name}", file=sys.stderr)
+            result = run_in_subprocess(name, args, cache_dir)
+            if name in args.benchmarks:
+                results["benchmarks"][name] = result
+    finally:
+        shutil.rmtree(cache_dir)
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "wt") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+
+"""
+Check that the taxonomy index gives the same answers as the code it replaced.
+
+Two checks run on a taxdump written by benchmarks/generate_taxdump.py:
+
+    incremental  Writes a series of synthetic taxdump releases, with taxa
+                 removed, moved, added and inserted, and updates one cached
+                 index from release to release. Each update must give the
+                 same index as a cold build of that release.
+    baseline     Looks up a sample of taxids by walking the skbio taxonomy
+                 tree, as the lookups did before the index, including the
+                 pruning of the Augustus tree that kept every other child of
+                 some datasets. The index must give the same datasets and
+                 genetic codes.
+
+Exits with status 1 if any check fails.
+
+    python3 extras/benchmarks/generate_taxdump.py test-output/equivalence \\
+        --n_taxa 100000
+    python3 extras/check_equivalence.py test-output/equivalence
+"""
+
+import argparse
+import io
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+CHECKS = ["incremental", "baseline"]
+
+# Arrays of the index that must be identical. The dataset codes are compared
+# as dataset names, because codes can be assigned in a different order.
+EXACT_ARRAYS = (
+    "parent",
+    "rank_code",
+    "genetic_code",
+    "mito_code",
+    "augustus_taxids",
+    "merged_from",
+    "merged_to",
+    "deleted",
+    "preorder",
+    "preorder_taxids",
+    "preorder_depth",
+    "preorder_size",
+    "lca_table",
+)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+
+    parser.add_argument(
+        "data_dir", type=Path, help="Directory written by generate_taxdump.py"
+    )
+    parser.add_argument(
+        "--checks",
+        nargs="+",
+        choices=CHECKS,
+        help="Checks to run. Defaults to all of them.",
+        default=CHECKS,
+    )
+    parser.add_argument(
+        "--releases",
+        type=int,
+        help="Number of synthetic releases for the incremental check",
+        default=3,
+    )
+    parser.add_argument(
+        "--changes",
+        type=int,
+        help="Number of taxa removed, moved and added in each release",
+        default=100,
+    )
+    parser.add_argument(
+        "--n_queries",
+        type=int,
+        help="Number of taxids to look up in the baseline check",
+        default=2000,
+    )
+    parser.add_argument("--seed", type=int, help="Random seed", default=1)
+
+    return parser.parse_args()
+
+
+def read_index(data_dir, nodes_file, cache_dir, with_merged=True):
+    from atol_reference_data_lookups.tree import read_taxonomy_index
+
+    return read_taxonomy_index(
+        nodes_file,
+        Path(data_dir, "names.dmp"),
+        Path(data_dir, "busco_placement.txt.tar.gz"),
+        Path(data_dir, "augustus_mapping.tsv"),
+        cache_dir,
+        merged_file=Path(data_dir, "merged.dmp") if with_merged else None,
+        delnodes_file=Path(data_dir, "delnodes.dmp") if with_merged else None,
+    )
+
+
+def dataset_names(codes, datasets):
+    return np.array(list(datasets) + [None], dtype=object)[codes]
+
+
+def compare_indexes(a, b):
+    """Return the names of the parts of index a that differ from index b."""
+    differences = [
+        name
+        for name in EXACT_ARRAYS
+        if not np.array_equal(getattr(a, name), getattr(b, name))
+    ]
+    if a.rank_names != b.rank_names:
+        differences.append("rank_names")
+    for name in ("busco", "augustus"):
+        names_a = dataset_names(
+            getattr(a, f"{name}_code"), getattr(a, f"{name}_datasets")
+        )
+        names_b = dataset_names(
+            getattr(b, f"{name}_code"), getattr(b, f"{name}_datasets")
+        )
+        if not np.array_equal(names_a, names_b):
+            differences.append(f"{name}_code")
+    return differences
+
+
+def read_nodes(nodes_file):
+    """Return the rows of nodes.dmp as a dict of taxid to a list of fields."""
+    rows = {}
+    with open(nodes_file, "rt") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t|\t")
+            rows[int(fields[0])] = fields
+    return rows
+
+
+def write_nodes(nodes_file, rows):
+    with open(nodes_file, "wt") as f:
+        for taxid in sorted(rows):
+            f.write("\t|\t".join(rows[taxid]) + "\n")
+
+
+def next_release(rows, n_changes, dataset_taxids, rng):
+    """
+    Edit rows, from read_nodes, into the next release of the taxonomy. Leaf
+    taxa are removed, taxa and some datasets are moved to new parents, new
+    taxa are added, and new taxa are inserted between a node and some of its
+    children.
+    """
+    parent = {taxid: int(fields[1]) for taxid, fields in rows.items()}
+
+    def is_below(taxid, clade):
+        while True:
+            if taxid == clade:
+                return True
+            if parent[taxid] == taxid:
+                return False
+            taxid = parent[taxid]
+
+    def set_parent(taxid, parent_taxid):
+        parent[taxid] = parent_taxid
+        rows[taxid][1] = str(parent_taxid)
+
+    internal = {x for taxid, x in parent.items() if x != taxid}
+    leaves = [taxid for taxid in rows if taxid not in internal]
+    for taxid in rng.sample(leaves, min(n_changes, len(leaves))):
+        del rows[taxid]
+        del parent[taxid]
+
+    taxids = sorted(rows)
+    movers = rng.sample(taxids[1:], min(n_changes, len(taxids) - 1))
+    movers += [x for x in rng.sample(dataset_taxids, 3) if x in rows]
+    for taxid in movers:
+        parent_taxid = rng.choice(taxids)
+        if taxid != taxids[0] and not is_below(parent_taxid, taxid):
+            set_parent(taxid, parent_taxid)
+
+    next_taxid = max(rows) + 1
+    template = rows[taxids[0]]
+    for _ in range(n_changes):
+        parent_taxid = rng.choice(taxids)
+        rows[next_taxid] = [str(next_taxid), str(parent_taxid), "species"]
+        rows[next_taxid] += template[3:]
+        parent[next_taxid] = parent_taxid
+        next_taxid += rng.choice([1, 1, 2])
+
+    for parent_taxid in rng.sample(sorted(internal & set(rows)), 5):
+        children = [
+            taxid
+            for taxid, x in parent.items()
+            if x == parent_taxid and taxid != parent_taxid
+        ]
+        rows[next_taxid] = [str(next_taxid), str(parent_taxid), "no rank"]
+        rows[next_taxid] += template[3:]
+        parent[next_taxid] = parent_taxid
+        for taxid in children[: len(children) // 2]:
+            set_parent(taxid, next_taxid)
+        next_taxid += 1
+
+
+def check_incremental(data_dir, work_dir, n_releases, n_changes, rng):
+    from atol_reference_data_lookups.io import read_augustus_mapping
+    from atol_reference_data_lookups.io import read_busco_mapping
+
+    dataset_taxids = sorted(
+        set(read_augustus_mapping(Path(data_dir, "augustus_mapping.tsv")))
+        | set(read_busco_mapping(Path(data_dir, "busco_placement.txt.tar.gz")))
+    )
+    cache_dir = Path(work_dir, "incremental")
+    read_index(data_dir, Path(data_dir, "nodes.dmp"), cache_dir)
+
+    rows = read_nodes(Path(data_dir, "nodes.dmp"))
+    failures = 0
+    for release in range(1, n_releases + 1):
+        next_release(rows, n_changes, dataset_taxids, rng)
+        nodes_file = Path(work_dir, f"nodes.{release}.dmp")
+        write_nodes(nodes_file, rows)
+
+        updated = read_index(data_dir, nodes_file, cache_dir)
+        cold = read_index(data_dir, nodes_file, Path(work_dir, f"cold.{release}"))
+        differences = compare_indexes(updated, cold)
+        if differences:
+            failures += 1
+            print(
+                f"incremental: release {release} differs from a cold build in "
+                f"{', '.join(differences)}",
+                file=sys.stderr,
+            )
+        else:
+            print(f"incremental: release {release} matches", file=sys.stderr)
+    return failures
+
+
+def baseline_augustus_tree(tree, augustus_mapping):
+    """Prune a copy of tree for the Augustus datasets, as the skbio code did."""
+    from atol_reference_data_lookups.tree import get_node
+
+    augustus_tree = tree.copy(deep=True)
+    augustus_nodes = [get_node(augustus_tree, x) for x in augustus_mapping]
+    augustus_nodes = [node for node in augustus_nodes if node is not None]
+    for node in augustus_nodes:
+        if node.has_children():
+            # Removing children from the list being iterated over is the quirk
+            # that TaxonomyIndex.augustus_tree_taxids reproduces.
+            for child in node.children:
+                node.remove(child)
+            if not node.is_tip():
+                node.pop()
+    return augustus_tree.shear(
+        names=[x.name for x in augustus_nodes], prune=False, strict=False
+    )
+
+
+def baseline_lookup(tree, nodes_full, busco_mapping, augustus, taxid):
+    """
+    Return the (busco, augustus, genetic code, mitochondrial genetic code) of
+    taxid by walking the skbio trees, or None if it is not in the tree.
+    augustus is a tuple of the pruned tree and the mapping.
+    """
+    import skbio.tree._exception
+
+    from atol_reference_data_lookups.tree import get_node
+
+    node = get_node(tree, taxid)
+    if node is None:
+        return None
+    ancestor_taxids = [int(x.name) for x in node.ancestors()]
+
+    busco = next(
+        (busco_mapping[x] for x in ancestor_taxids if x in busco_mapping), None
+    )
+
+    # TreeNode defines __len__, so tips are falsy. The old code tested the
+    # nodes for truth, which skipped tips of the Augustus tree and kept
+    # climbing to the first internal node.
+    augustus_tree, augustus_mapping = augustus
+    closest = None
+    search_taxids = [taxid] + ancestor_taxids
+    while not closest and search_taxids:
+        closest = get_node(augustus_tree, search_taxids.pop(0))
+    augustus_dataset = None
+    if closest:
+        distances = {}
+        for augustus_taxid in augustus_mapping:
+            dest_node = get_node(augustus_tree, augustus_taxid)
+            if dest_node is None:
+                continue
+            try:
+                distances[augustus_taxid] = closest.distance(
+                    dest_node, use_length=False
+                )
+            except skbio.tree._exception.MissingNodeError:
+                continue
+        if distances:
+            augustus_dataset = augustus_mapping[min(distances, key=distances.get)]
+
+    row = nodes_full.loc[taxid]
+    return (
+        busco,
+        augustus_dataset,
+        int(row["genetic_code_id"]),
+        int(row["mitochondrial_genetic_code_id"]),
+    )
+
+
+def write_tip_under_dataset(data_dir):
+    """
+    Write a small taxdump where Augustus dataset 2 has children 10 to 13 and
+    child 11 is also a dataset. The old pruning kept 11 as a tip under 2, so
+    taxids below 11 get dataset A from 2, not dataset B from 11.
+    """
+    edges = [(1, 1), (2, 1), (3, 1), (30, 3), (31, 3), (20, 11), (21, 20)]
+    edges += [(x, 2) for x in range(10, 14)]
+    Path.mkdir(Path(data_dir), exist_ok=True, parents=True)
+    with open(Path(data_dir, "nodes.dmp"), "wt") as f:
+        for taxid, parent in sorted(edges):
+            fields = [taxid, parent, "no rank", "", 0, 1, 1, 1, 2, 1]
+            fields += [0, 0, "", 0, 0, 0, 0, 0]
+            f.write("\t|\t".join(str(x) for x in fields) + "\t|\n")
+    with open(Path(data_dir, "names.dmp"), "wt") as f:
+        for taxid, _ in sorted(edges):
+            f.write(f"{taxid}\t|\tTaxon {taxid}\t|\t\t|\tscientific name\t|\n")
+    with open(Path(data_dir, "augustus_mapping.tsv"), "wt") as f:
+        f.write("2\tA\n11\tB\n31\tC\n")
+
+    data = b"#taxid\tbusco_lineage\n2\tlineage_a_odb10\n11\tlineage_b_odb10\n"
+    member = tarfile.TarInfo("mapping_taxids-busco_dataset_name.txt")
+    member.size = len(data)
+    with tarfile.open(Path(data_dir, "busco_placement.txt.tar.gz"), "w:gz") as tar:
+        tar.addfile(member, io.BytesIO(data))
+
+
+def check_baseline(data_dir, work_dir, n_queries, rng, name="baseline"):
+    import skbio.io
+    import pandas as pd
+    from skbio.tree import TreeNode
+
+    from atol_reference_data_lookups.io import read_augustus_mapping
+    from atol_reference_data_lookups.io import read_busco_mapping
+
+    nodes_file = Path(data_dir, "nodes.dmp")
+    index = read_index(data_dir, nodes_file, Path(work_dir, name), False)
+
+    print(f"{name}: building the skbio tree", file=sys.stderr)
+    nodes = skbio.io.read(
+        str(nodes_file), "taxdump", into=pd.DataFrame, scheme="nodes_slim"
+    )
+    nodes_full = skbio.io.read(
+        str(nodes_file), "taxdump", into=pd.DataFrame, scheme="nodes"
+    )
+    tree = TreeNode.from_taxdump(nodes)
+    tree.index_tree()
+    busco_mapping = read_busco_mapping(Path(data_dir, "busco_placement.txt.tar.gz"))
+    augustus_mapping = read_augustus_mapping(Path(data_dir, "augustus_mapping.tsv"))
+    augustus = (baseline_augustus_tree(tree, augustus_mapping), augustus_mapping)
+
+    # A few taxids that are not in the tree are included, which both should
+    # leave out.
+    taxids = index.taxids.tolist()
+    queries = rng.sample(taxids, min(n_queries, len(taxids)))
+    queries += [taxids[-1] + x for x in range(1, 11)]
+    results = dict(index.lookup_many(queries).records())
+
+    print(f"{name}: looking up {len(queries)} taxids", file=sys.stderr)
+    mismatches = []
+    for taxid in queries:
+        expected = baseline_lookup(tree, nodes_full, busco_mapping, augustus, taxid)
+        result = results.get(taxid)
+        if result is not None:
+            result = (
+                result["busco_dataset_name"],
+                result["augustus_dataset_name"],
+                result["genetic_code_id"],
+                result["mitochondrial_genetic_code_id"],
+            )
+        if result != expected:
+            mismatches.append((taxid, expected, result))
+
+    for taxid, expected, result in mismatches[:10]:
+        print(
+            f"{name}: {taxid} is {result}, the tree walk gives {expected}",
+            file=sys.stderr,
+        )
+    print(
+        f"{name}: {len(queries) - len(mismatches)} of {len(queries)} taxids match",
+        file=sys.stderr,
+    )
+    return int(bool(mismatches))
+
+
+def main():
+    args = parse_arguments()
+
+    from atol_reference_data_lookups import setup_logger
+
+    setup_logger("WARNING")
+    rng = random.Random(args.seed)
+
+    failures = 0
+    work_dir = Path(tempfile.mkdtemp(prefix="atol_equivalence_"))
+    try:
+        if "incremental" in args.checks:
+            failures += check_incremental(
+                args.data_dir, work_dir, args.releases, args.changes, rng
+            )
+        if "baseline" in args.checks:
+            # A regression case for how the old code searched the Augustus
+            # tree, which the synthetic taxdump rarely hits.
+            tiny_dir = Path(work_dir, "tip_under_dataset")
+            write_tip_under_dataset(tiny_dir)
+            failures += check_baseline(
+                tiny_dir, work_dir, args.n_queries, rng, "tip_under_dataset"
+            )
+            failures += check_baseline(args.data_dir, work_dir, args.n_queries, rng)
+    finally:
+        shutil.rmtree(work_dir)
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""
+Check that the command line entry points import quickly.
+
+Each module is imported in a fresh interpreter with python -X importtime. The
+check fails if the import takes longer than its budget, or if it imports one
+of the slow modules that should only be loaded when a cache is rebuilt or a
+workflow is run.
+
+Run from the repository root with `make -f extras/Makefile import_time`.
+"""
+
+import subprocess
+import sys
+
+# Import time budgets in seconds. These are well above the time on a laptop
+# with a warm page cache, to allow for slower cluster filesystems.
+IMPORT_BUDGETS = {
+    "atol_reference_data_lookups.atol_reference_data_lookups": 0.5,
+    "get_remote_files.get_remote_files": 0.2,
+}
+
+# Modules that must not be imported just to start the command line tools.
+DEFERRED_MODULES = ("pandas", "skbio", "snakemake")
+
+# Number of times to import each module. The fastest run is used.
+REPEATS = 3
+
+
+def measure_import(module):
+    """
+    Import module in a new interpreter. Returns a tuple of the cumulative
+    import time in seconds and the set of top-level packages imported.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    import_time = None
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        name = name.strip()
+        imported.add(name.split(".")[0])
+        if name == module:
+            import_time = int(cumulative) / 1e6
+    return import_time, imported
+
+
+def main():
+    failed = False
+    for module, budget in IMPORT_BUDGETS.items():
+        runs = [measure_import(module) for _ in range(REPEATS)]
+        import_time = min(x[0] for x in runs)
+        deferred = sorted(set(DEFERRED_MODULES).intersection(runs[0][1]))
+
+        status = "ok"
+        if import_time > budget:
+            status = f"over budget of {budget:.2f}s"
+            failed = True
+        if deferred:
+            status = f"imports {', '.join(deferred)}"
+            failed = True
+        print(f"{module}: {import_time:.3f}s {status}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,33 @@
 from .taxdump_tree import TaxdumpTree
+from .bundle import bundle_checksums, read_manifest, write_bundle
+from .index import MISSING
+from .names import AMBIGUOUS, NOT_FOUND
+from .store import DEFAULT_MAX_ROWS
+from .output import (
+    ARROW_FORMATS,
+    DESCENDANT_COLUMNS,
+    IN_CLADE_COLUMNS,
+    LOOKUP_COLUMNS,
+    NAME_LOOKUP_COLUMNS,
+    PAIR_COLUMNS,
+    RANK_SUMMARY_COLUMNS,
+    STREAMING_FORMATS,
+    open_writer,
+)
+from .tree import INDEX_CACHE_FILE, get_reference_files
 from atol_reference_data_lookups import logger
+from atol_reference_data_lookups.metrics import metrics
 from argparse import ArgumentParser, Namespace
+from contextlib import nullcontext
+from importlib.util import find_spec
 from pathlib import Path
 import importlib.resources as pkg_resources
 import os
 import sys
 import json
 
+import numpy as np
+
 
 def parse_args() -> Namespace:
     # Note to self, this returns a Path
@@ -17,6 +38,7 @@ def parse_args() -> Namespace:
     input_group = parser.add_argument_group("Input")
     ref_group = parser.add_argument_group("Reference data")
     options_group = parser.add_argument_group("General options")
+    server_group = parser.add_argument_group("Lookup server")
 
     taxid_group = input_group.add_mutually_exclusive_group()
 
@@ -26,28 +48,148 @@ def parse_args() -> Namespace:
         help=(
             """
             A file containing a list NCBI TaxIds to look up, one per line.
+            Use - to read from Standard Input. Blank lines are ignored.
+            """
+        ),
+        type=Path,
+    )
+
+    taxid_group.add_argument(
+        "--name",
+        help=(
+            """
+            A single scientific name, synonym or common name from names.dmp
+            to look up. Names are matched without case.
+            """
+        ),
+    )
+    taxid_group.add_argument(
+        "--name-list",
+        help=(
+            """
+            A file containing a list of names to look up, one per line. Use -
+            to read from Standard Input. Blank lines are ignored.
             """
         ),
         type=Path,
     )
 
+    taxid_group.add_argument(
+        "--pair-list",
+        help=(
+            """
+            A file containing pairs of NCBI TaxIds, two per line separated by
+            whitespace. Prints the lowest common ancestor of each pair and the
+            number of edges between them, instead of looking up datasets. Use
+            - to read from Standard Input.
+            """
+        ),
+        type=Path,
+    )
+
+    taxid_group.add_argument(
+        "--descendants",
+        metavar="TAXID",
+        help=(
+            """
+            Print every TaxId under TAXID, in pre-order, with its rank,
+            instead of looking up datasets.
+            """
+        ),
+        type=int,
+    )
+    taxid_group.add_argument(
+        "--rank-summary",
+        metavar="TAXID",
+        help=(
+            """
+            Print the number of TaxIds of each rank in the clade TAXID,
+            including TAXID itself, instead of looking up datasets.
+            """
+        ),
+        type=int,
+    )
+    input_group.add_argument(
+        "--in-clade",
+        metavar="TAXID",
+        help=(
+            """
+            Instead of looking up datasets, print whether each --taxid or
+            --taxid-list TaxId is TAXID or one of its descendants. Merged
+            TaxIds are resolved first.
+            """
+        ),
+        type=int,
+    )
+
+    ref_group.add_argument(
+        "--index",
+        metavar="BUNDLE",
+        help=(
+            """
+            Index bundle built with --build-index, e.g. by get-remote-files.
+            The lookups are answered from the bundle, which is only read, so
+            the other reference data options are not needed.
+            """
+        ),
+        type=Path,
+    )
+
+    ref_group.add_argument(
+        "--build-index",
+        metavar="BUNDLE",
+        help=(
+            """
+            Build an index bundle in the directory BUNDLE from the reference
+            data, for use with --index, instead of looking anything up.
+            """
+        ),
+        type=Path,
+    )
+
+    ref_group.add_argument(
+        "--nodes", help="NCBI nodes.dmp file from taxdump", type=Path
+    )
+
     ref_group.add_argument(
-        "--nodes", required=True, help="NCBI nodes.dmp file from taxdump", type=Path
+        "--names", help="NCBI names.dmp file from taxdump", type=Path
     )
 
     ref_group.add_argument(
-        "--names", required=True, help="NCBI names.dmp file from taxdump", type=Path
+        "--merged",
+        help=(
+            """
+            NCBI merged.dmp file from taxdump. Optional. TaxIds that have been
+            merged into another TaxId are looked up as the TaxId they were
+            merged into.
+            """
+        ),
+        type=Path,
+    )
+
+    ref_group.add_argument(
+        "--delnodes",
+        help=(
+            """
+            NCBI delnodes.dmp file from taxdump. Optional. Deleted TaxIds are
+            reported as deleted instead of missing.
+            """
+        ),
+        type=Path,
     )
 
     ref_group.add_argument(
         "--taxids_to_busco_dataset_mapping",
-        required=True,
         help=(
             """
               BUSCO placement file from
-              https://busco-data.ezlab.org/v5/data/placement_files/
+              https://busco-data.ezlab.org/v5/data/placement_files/. Give
+              several files, e.g. for eukaryota, bacteria and archaea, to
+              merge them into one mapping. If they map a TaxId to different
+              datasets, the last file wins.
             """
         ),
+        nargs="+",
         type=Path,
     )
 
@@ -76,67 +218,665 @@ def parse_args() -> Namespace:
         ),
     )
 
-    return parser.parse_args()
+    options_group.add_argument(
+        "--verify-cache",
+        help=(
+            """
+            Hash every reference file to check the cache. By default, files
+            are only hashed if their size, modification time or inode has
+            changed since they were last hashed. With --index, hash the files
+            in the bundle and check them against its manifest.
+            """
+        ),
+        action="store_true",
+    )
+
+    options_group.add_argument(
+        "--output-format",
+        help=(
+            """
+            json writes one JSON object once all lookups are done. The other
+            formats are written as the input is read, in chunks of
+            --chunk_size TaxIds, so memory use does not depend on the length
+            of the input. ndjson writes one JSON record per line, tsv writes
+            tab-separated values with a header, and parquet and arrow (an
+            Arrow IPC stream) write one row group per chunk, with dataset
+            names dictionary encoded. parquet and arrow need pyarrow.
+            """
+        ),
+        choices=["json", *STREAMING_FORMATS],
+        default="json",
+    )
+
+    options_group.add_argument(
+        "--chunk_size",
+        help="Number of TaxIds to look up at a time, except with --output-format json",
+        type=int,
+        default=100000,
+    )
+
+    options_group.add_argument(
+        "--metrics",
+        metavar="FILE",
+        help=(
+            """
+            Write the wall time, CPU time and peak RSS of each phase of the
+            run, cache hits and misses, and lookups per second as JSON to
+            FILE. Without FILE, or with -, the JSON is written to Standard
+            Error.
+            """
+        ),
+        nargs="?",
+        const="-",
+    )
+
+    options_group.add_argument(
+        "--workers",
+        help=(
+            """
+            Number of processes to look up TaxIds and format the output in.
+            The processes share the cached taxonomy index through mmap, so
+            memory use does not grow with the number of workers. Only used
+            with --taxid-list, and not with --connect.
+            """
+        ),
+        type=int,
+        default=1,
+    )
+
+    options_group.add_argument(
+        "--result-store",
+        action="store_true",
+        help=(
+            """
+            Keep the result of each TaxId lookup in an SQLite store in
+            --cache_dir, and take TaxIds that were looked up before from the
+            store. Results are only reused with the same reference data.
+            """
+        ),
+    )
+
+    options_group.add_argument(
+        "--result-store-size",
+        help=(
+            """
+            Maximum number of results to keep in the --result-store. The
+            least recently used results are evicted first.
+            """
+        ),
+        type=int,
+        default=DEFAULT_MAX_ROWS,
+    )
+
+    server_mode_group = server_group.add_mutually_exclusive_group()
+
+    server_mode_group.add_argument(
+        "--serve",
+        metavar="ADDRESS",
+        help=(
+            """
+            Load the reference data once and answer lookups over HTTP on
+            ADDRESS, which is unix:/path/to/socket or [host:]port. Endpoints
+            are GET /health, GET /ready, GET /lookup?taxid=..., POST /lookup
+            with a JSON list of TaxIds, and POST /reload to reload the
+            reference data if it has changed.
+            """
+        ),
+    )
+
+    server_mode_group.add_argument(
+        "--connect",
+        metavar="ADDRESS",
+        help=(
+            """
+            Send the lookups to a server started with --serve at ADDRESS,
+            instead of loading the reference data. The reference data
+            options are not needed.
+            """
+        ),
+    )
+
+    args = parser.parse_args()
+
+    inputs = (
+        "taxid",
+        "taxid_list",
+        "name",
+        "name_list",
+        "pair_list",
+        "descendants",
+        "rank_summary",
+    )
+    if (
+        args.serve is None
+        and args.build_index is None
+        and all(getattr(args, x) is None for x in inputs)
+    ):
+        parser.error(
+            "one of the arguments --taxid --taxid-list --name --name-list "
+            "--pair-list --descendants --rank-summary is required"
+        )
+
+    if args.in_clade is not None and args.taxid is None and args.taxid_list is None:
+        parser.error("--in-clade needs --taxid or --taxid-list")
+
+    if args.connect is not None:
+        for option in (
+            "name",
+            "name_list",
+            "pair_list",
+            "descendants",
+            "rank_summary",
+            "in_clade",
+        ):
+            if getattr(args, option) is not None:
+                parser.error(
+                    f"--{option.replace('_', '-')} can't be used with --connect"
+                )
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    if args.chunk_size < 1:
+        parser.error("--chunk_size must be at least 1")
+
+    if args.connect is not None and args.workers > 1:
+        parser.error("--workers can't be used with --connect")
+
+    if args.output_format in ARROW_FORMATS and find_spec("pyarrow") is None:
+        parser.error(f"--output-format {args.output_format} needs pyarrow")
+
+    if args.workers > 1 and args.output_format not in ("json", "ndjson"):
+        parser.error("--workers only supports --output-format json or ndjson")
+
+    if args.result_store and (args.connect is not None or args.workers > 1):
+        parser.error("--result-store can't be used with --connect or --workers")
+
+    if args.index is not None:
+        if args.connect is not None or args.build_index is not None:
+            parser.error("--index can't be used with --connect or --build-index")
+        for option in ("nodes", "names", "merged", "delnodes"):
+            if getattr(args, option) is not None:
+                parser.error(f"--{option} can't be used with --index")
+        if args.taxids_to_busco_dataset_mapping is not None:
+            parser.error("--taxids_to_busco_dataset_mapping can't be used with --index")
+        try:
+            read_manifest(args.index)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.build_index is not None and args.connect is not None:
+        parser.error("--build-index can't be used with --connect")
+
+    if args.connect is None and args.index is None:
+        for option in ("nodes", "names", "taxids_to_busco_dataset_mapping"):
+            if getattr(args, option) is None:
+                parser.error(f"the following arguments are required: --{option}")
+
+    return args
+
+
+def open_taxid_list(taxid_list_file: Path):
+    if str(taxid_list_file) == "-":
+        return nullcontext(sys.stdin)
+    return open(taxid_list_file, "rt")
+
+
+def read_taxid_chunks(f, chunk_size: int):
+    """Yield lists of up to chunk_size taxids from f, skipping blank lines."""
+    chunk = []
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        chunk.append(int(line))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
 def read_taxid_list(taxid_list_file: Path) -> list[int]:
-    with open(taxid_list_file, "rt") as f:
-        taxid_list = [int(x) for x in f.read().splitlines()]
+    with open_taxid_list(taxid_list_file) as f:
+        taxid_list = [x for chunk in read_taxid_chunks(f, 100000) for x in chunk]
     return taxid_list
 
 
+def read_name_list(name_list_file: Path) -> list[str]:
+    with open_taxid_list(name_list_file) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def read_pair_list(pair_list_file: Path):
+    """Return two lists of the first and second taxid of each pair."""
+    taxids_a = []
+    taxids_b = []
+    with open_taxid_list(pair_list_file) as f:
+        for i, line in enumerate(f, 1):
+            fields = line.split()
+            if not fields:
+                continue
+            if len(fields) != 2:
+                raise ValueError(f"Expected two TaxIds at line {i} of {pair_list_file}")
+            taxids_a.append(int(fields[0]))
+            taxids_b.append(int(fields[1]))
+    return taxids_a, taxids_b
+
+
 def write_json_output(data_dict: dict) -> None:
     json.dump(data_dict, sys.stdout)
 
 
-def main() -> None:
-    args = parse_args()
-
-    if args.taxid is not None:
-        query_taxids = [args.taxid]
+def write_records(records: list[dict], output_format: str, columns) -> None:
+    """
+    Write a list of dicts as a JSON list, or in one of the streaming formats
+    with columns.
+    """
+    if output_format == "json":
+        json.dump(records, sys.stdout)
     else:
-        query_taxids = read_taxid_list(taxid_list_file=args.taxid_list)
+        with open_writer(output_format, columns) as writer:
+            writer.write(records)
+
+
+def lookup_rows(records) -> list[dict]:
+    """Return (taxid, result) records as dicts with the taxid as a field."""
+    return [{"taxid": taxid, **result} for taxid, result in records]
+
 
-    taxdump_tree = TaxdumpTree(
+def log_lookup_counts() -> None:
+    counters = metrics.counters
+    logger.info(f"Finished lookups for {counters.get('queries', 0)} query_taxids")
+    if counters.get("merged_taxids", 0) > 0:
+        logger.info(
+            f"{counters['merged_taxids']} query taxon_ids were merged into other "
+            "taxon_ids"
+        )
+    if counters.get("deleted_taxids", 0) > 0:
+        logger.warning(f"{counters['deleted_taxids']} query taxon_ids have been deleted")
+    if counters.get("missing_taxids", 0) > 0:
+        logger.warning(
+            f"{counters['missing_taxids']} query taxon_ids were not found in the tree"
+        )
+    if "result_store_hits" in counters:
+        logger.info(
+            f"{counters['result_store_hits']} taxon_ids were found in the result "
+            f"store and {counters['result_store_misses']} were looked up"
+        )
+
+
+def stream_lookups(
+    lookup, taxid_list_file: Path, chunk_size: int, output_format: str
+) -> None:
+    with (
+        open_taxid_list(taxid_list_file) as f,
+        open_writer(output_format, LOOKUP_COLUMNS) as writer,
+    ):
+        for chunk in read_taxid_chunks(f, chunk_size):
+            writer.write(lookup_rows(lookup(chunk)))
+            logger.debug(f"Looked up {metrics.counters['queries']} query_taxids")
+
+
+def stream_parallel_lookups(pool, taxid_list_file: Path, chunk_size: int) -> None:
+    with open_taxid_list(taxid_list_file) as f:
+        chunks = read_taxid_chunks(f, chunk_size)
+        for output, counts in pool.map_ndjson(chunks):
+            sys.stdout.write(output)
+            for key, n in counts.items():
+                metrics.count(key, n)
+            logger.debug(f"Looked up {metrics.counters['queries']} query_taxids")
+    sys.stdout.flush()
+
+
+def load_taxdump_tree(args: Namespace) -> TaxdumpTree:
+    return TaxdumpTree(
         args.nodes,
         args.names,
         args.taxids_to_busco_dataset_mapping,
         args.taxids_to_augustus_dataset_mapping,
         args.cache_dir,
+        verify_cache=args.verify_cache,
+        merged_file=args.merged,
+        delnodes_file=args.delnodes,
+        index_bundle=args.index,
     )
 
-    logger.info(f"Looking up {len(query_taxids)} query_taxids")
 
-    taxonomy_reference_data = {}
+def get_lookup_function(args: Namespace):
+    """
+    Return a function that takes a list of taxids and returns an iterable of
+    (taxid, result) records. The numbers of queries, and of missing, merged
+    and deleted taxids, are added to the metrics counters. Lookups go to a server if
+    --connect was given.
+    """
+    if args.connect is not None:
+        from atol_reference_data_lookups.server import request_lookups
 
-    missing_nodes = []
+        logger.info(f"Sending lookups to {args.connect}")
 
-    for query_taxid in query_taxids:
-        if taxdump_tree.get_node(query_taxid) is None:
-            missing_nodes.append(query_taxid)
-            continue
+        def lookup(taxids):
+            results, counts = request_lookups(args.connect, taxids)
+            for key, n in counts.items():
+                metrics.count(key, n)
+            return [(x.pop("taxid"), x) for x in results]
 
-        ancestor_taxids = taxdump_tree.get_ancestor_taxids(query_taxid)
+    elif args.result_store:
+        from atol_reference_data_lookups.cache import get_checksums
+        from atol_reference_data_lookups.store import RESULT_STORE_FILE, ResultStore
 
-        genetic_code_id, mitochondrial_genetic_code_id = taxdump_tree.get_genetic_codes(
-            query_taxid
+        if args.index is not None:
+            checksums = bundle_checksums(read_manifest(args.index))
+        else:
+            checksums = get_checksums(
+                reference_files_from_args(args),
+                args.cache_dir,
+                verify=args.verify_cache,
+            )
+        store = ResultStore(
+            Path(args.cache_dir, RESULT_STORE_FILE),
+            checksums,
+            max_rows=args.result_store_size,
         )
+        logger.info(f"Using result store {store.file_path}")
+        taxdump_tree = None
+
+        # The taxonomy is only loaded if some of the taxids aren't in the store.
+        def lookup_many(taxids):
+            nonlocal taxdump_tree
+            if taxdump_tree is None:
+                taxdump_tree = load_taxdump_tree(args)
+            return taxdump_tree.lookup_many(taxids)
+
+        def lookup(taxids):
+            records, counts = store.lookup(taxids, lookup_many)
+            for key, n in counts.items():
+                metrics.count(key, n)
+            return records
+
+    else:
+        taxdump_tree = load_taxdump_tree(args)
+
+        def lookup(taxids):
+            results = taxdump_tree.lookup_many(taxids)
+            for key, n in results.counts().items():
+                metrics.count(key, n)
+            return results.records()
+
+    return lookup
+
+
+def get_lookup_pool(args: Namespace):
+    """
+    Load the reference data, so that the cached index is up to date, and
+    return a LookupPool of --workers processes that share it.
+    """
+    from atol_reference_data_lookups.parallel import LookupPool
+
+    checksums = load_taxdump_tree(args).index.checksums
+    index_dir = args.cache_dir if args.index is None else args.index
+    return LookupPool(Path(index_dir, INDEX_CACHE_FILE), args.workers, checksums)
+
+
+def reference_files_from_args(args: Namespace) -> dict:
+    """
+    Return the reference files as a dict with the same keys as the checksums
+    in the taxonomy index.
+    """
+    return get_reference_files(
+        args.nodes,
+        args.names,
+        args.taxids_to_busco_dataset_mapping,
+        args.taxids_to_augustus_dataset_mapping,
+        args.merged,
+        args.delnodes,
+    )
+
+
+def serve_lookups(args: Namespace) -> None:
+    from atol_reference_data_lookups.server import LookupService, serve
 
-        taxonomy_reference_data[query_taxid] = {
-            "busco_dataset_name": taxdump_tree.get_busco_lineage(
-                query_taxid, ancestor_taxids
-            ),
-            "augustus_dataset_name": taxdump_tree.get_augustus_lineage(
-                query_taxid, ancestor_taxids
-            ),
-            "genetic_code_id": int(genetic_code_id),
-            "mitochondrial_genetic_code_id": int(mitochondrial_genetic_code_id),
+    service = LookupService(
+        lambda: load_taxdump_tree(args),
+        None if args.index is not None else reference_files_from_args(args),
+        args.cache_dir,
+        index_bundle=args.index,
+    )
+    serve(args.serve, service)
+
+
+def build_index_bundle(args: Namespace) -> None:
+    taxdump_tree = load_taxdump_tree(args)
+    manifest = write_bundle(
+        args.build_index,
+        taxdump_tree.index,
+        taxdump_tree.name_index,
+        reference_files_from_args(args),
+    )
+    logger.info(
+        f"Wrote index bundle of {manifest['contents']['taxids']} taxids "
+        f"to {args.build_index}"
+    )
+
+
+def run_pair_lookups(args: Namespace) -> None:
+    taxids_a, taxids_b = read_pair_list(args.pair_list)
+    index = load_taxdump_tree(args).index
+
+    logger.info(f"Finding common ancestors for {len(taxids_a)} pairs")
+    with metrics.phase("lookups"):
+        lca = index.lca_pairs(taxids_a, taxids_b).tolist()
+        distance = index.distance_pairs(taxids_a, taxids_b).tolist()
+    metrics.count("pairs", len(taxids_a))
+
+    records = [
+        {
+            "taxid_a": a,
+            "taxid_b": b,
+            "lca": lca_taxid if lca_taxid != MISSING else None,
+            "distance": n_edges if n_edges != MISSING else None,
         }
+        for a, b, lca_taxid, n_edges in zip(taxids_a, taxids_b, lca, distance)
+    ]
+    n_missing = sum(x["lca"] is None for x in records)
+    if n_missing > 0:
+        logger.warning(f"{n_missing} pairs have no common ancestor in the tree")
+
+    with metrics.phase("write_output"):
+        write_records(records, args.output_format, PAIR_COLUMNS)
+
 
-    logger.info("Finished lookups")
+def run_name_lookups(args: Namespace) -> None:
+    if args.name is not None:
+        names = [args.name]
+    else:
+        with metrics.phase("read_name_list"):
+            names = read_name_list(args.name_list)
+    taxdump_tree = load_taxdump_tree(args)
+
+    logger.info(f"Resolving {len(names)} names")
+    with metrics.phase("resolve_names"):
+        taxids = taxdump_tree.resolve_names(names)
+    metrics.count("names", len(names))
+    metrics.count("missing_names", int(np.count_nonzero(taxids == NOT_FOUND)))
+    metrics.count("ambiguous_names", int(np.count_nonzero(taxids == AMBIGUOUS)))
+    counters = metrics.counters
+    if counters["missing_names"] > 0:
+        logger.warning(f"{counters['missing_names']} names were not found")
+    if counters["ambiguous_names"] > 0:
+        logger.warning(
+            f"{counters['ambiguous_names']} names match more than one taxon_id. "
+            "Use the unique name from names.dmp instead."
+        )
 
-    n_missing_nodes = len(missing_nodes)
-    if n_missing_nodes > 0:
-        logger.warning(f"{n_missing_nodes} query taxon_ids were not found in the tree")
+    found = taxids >= 0
+    with metrics.phase("lookups"):
+        results = taxdump_tree.lookup_many(taxids[found])
+        for key, n in results.counts().items():
+            metrics.count(key, n)
+        records = [
+            (name, {"taxid": taxid, **result})
+            for name, (taxid, result) in zip(
+                (x for x, y in zip(names, found) if y), results.records()
+            )
+        ]
+
+    log_lookup_counts()
+
+    with metrics.phase("write_output"):
+        if args.output_format == "json":
+            write_json_output(dict(records))
+        else:
+            write_records(
+                [{"name": name, **result} for name, result in records],
+                args.output_format,
+                NAME_LOOKUP_COLUMNS,
+            )
+
+
+def run_clade_queries(args: Namespace) -> None:
+    taxdump_tree = load_taxdump_tree(args)
+    index = taxdump_tree.index
+
+    if args.descendants is not None:
+        with metrics.phase("lookups"):
+            taxids = taxdump_tree.get_descendant_taxids(args.descendants)
+            rank_names = np.array(index.rank_names, dtype=object)
+            records = [
+                {"taxid": taxid, "rank": rank}
+                for taxid, rank in zip(
+                    taxids.tolist(), rank_names[index.rank_code[taxids]].tolist()
+                )
+            ]
+        logger.info(f"Found {len(records)} descendants of {args.descendants}")
+        with metrics.phase("write_output"):
+            write_records(records, args.output_format, DESCENDANT_COLUMNS)
+
+    elif args.rank_summary is not None:
+        if args.rank_summary not in index:
+            logger.warning(f"TaxId {args.rank_summary} is not in the tree")
+        with metrics.phase("lookups"):
+            rank_counts = taxdump_tree.get_rank_counts(args.rank_summary)
+        if args.output_format in ("json", "ndjson"):
+            json.dump({"taxid": args.rank_summary, "ranks": rank_counts}, sys.stdout)
+            if args.output_format == "ndjson":
+                sys.stdout.write("\n")
+        else:
+            write_records(
+                [
+                    {"taxid": args.rank_summary, "rank": rank, "count": count}
+                    for rank, count in rank_counts.items()
+                ],
+                args.output_format,
+                RANK_SUMMARY_COLUMNS,
+            )
+
+    else:
+        if args.taxid is not None:
+            query_taxids = np.array([args.taxid], dtype=np.int64)
+        else:
+            with metrics.phase("read_taxid_list"):
+                query_taxids = np.array(
+                    read_taxid_list(args.taxid_list), dtype=np.int64
+                )
+        if args.in_clade not in index:
+            logger.warning(f"TaxId {args.in_clade} is not in the tree")
+        with metrics.phase("lookups"):
+            resolved, _ = index.resolve_many(query_taxids)
+            in_clade = taxdump_tree.in_clade_many(resolved, args.in_clade)
+        logger.info(
+            f"{np.count_nonzero(in_clade)} of {len(query_taxids)} query_taxids "
+            f"are in {args.in_clade}"
+        )
+        with metrics.phase("write_output"):
+            if args.output_format == "json":
+                write_json_output(dict(zip(query_taxids.tolist(), in_clade.tolist())))
+            else:
+                write_records(
+                    [
+                        {"taxid": taxid, "in_clade": x}
+                        for taxid, x in zip(query_taxids.tolist(), in_clade.tolist())
+                    ],
+                    args.output_format,
+                    IN_CLADE_COLUMNS,
+                )
+
+
+def run_lookups(args: Namespace) -> None:
+    if args.taxid is not None:
+        query_taxids = [args.taxid]
+    elif args.output_format != "json":
+        # streamed from args.taxid_list after the taxonomy is loaded
+        query_taxids = None
+    else:
+        with metrics.phase("read_taxid_list"):
+            query_taxids = read_taxid_list(taxid_list_file=args.taxid_list)
+
+    if args.workers > 1 and args.taxid is None:
+        run_parallel_lookups(args, query_taxids)
+        return
+
+    lookup = get_lookup_function(args)
+
+    if query_taxids is None:
+        with metrics.phase("lookups"):
+            stream_lookups(lookup, args.taxid_list, args.chunk_size, args.output_format)
+        log_lookup_counts()
+        return
+
+    logger.info(f"Looking up {len(query_taxids)} query_taxids")
+
+    with metrics.phase("lookups"):
+        records = lookup(query_taxids)
+
+    log_lookup_counts()
+
+    with metrics.phase("write_output"):
+        if args.output_format == "json":
+            write_json_output(dict(records))
+        else:
+            write_records(lookup_rows(records), args.output_format, LOOKUP_COLUMNS)
+
+
+def run_parallel_lookups(args: Namespace, query_taxids) -> None:
+    """
+    Look up and format the output in --workers processes. query_taxids is
+    None to stream the lookups from args.taxid_list.
+    """
+    with get_lookup_pool(args) as pool:
+        if query_taxids is None:
+            with metrics.phase("lookups"):
+                stream_parallel_lookups(pool, args.taxid_list, args.chunk_size)
+        else:
+            logger.info(f"Looking up {len(query_taxids)} query_taxids")
+            with metrics.phase("lookups"):
+                output, counts = pool.lookup_json(query_taxids)
+            for key, n in counts.items():
+                metrics.count(key, n)
+            with metrics.phase("write_output"):
+                sys.stdout.write(output)
+
+    log_lookup_counts()
+
+
+def main() -> None:
+    args = parse_args()
 
-    write_json_output(taxonomy_reference_data)
+    try:
+        if args.build_index is not None:
+            build_index_bundle(args)
+        elif args.serve is not None:
+            serve_lookups(args)
+        elif args.pair_list is not None:
+            run_pair_lookups(args)
+        elif any(
+            x is not None for x in (args.descendants, args.rank_summary, args.in_clade)
+        ):
+            run_clade_queries(args)
+        elif args.name is not None or args.name_list is not None:
+            run_name_lookups(args)
+        else:
+            run_lookups(args)
+    finally:
+        if args.metrics is not None:
+            metrics.write(args.metrics)
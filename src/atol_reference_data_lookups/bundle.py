@@ -0,0 +1,131 @@
+import json
+from datetime import datetime, timezone
+from pathlib import Path
+
+from atol_reference_data_lookups import logger
+from atol_reference_data_lookups.cache import atomic_write, compute_sha256
+from atol_reference_data_lookups.index import INDEX_VERSION, TaxonomyIndex
+from atol_reference_data_lookups.names import NAME_INDEX_VERSION, NameIndex
+from atol_reference_data_lookups.tree import INDEX_CACHE_FILE, NAME_INDEX_CACHE_FILE
+
+# An index bundle is a directory with the TaxonomyIndex and NameIndex, in the
+# same format as the cache, and a manifest that describes them. The manifest
+# is written last, so a bundle without one is incomplete.
+BUNDLE_MANIFEST = "manifest.json"
+BUNDLE_FILES = (INDEX_CACHE_FILE, NAME_INDEX_CACHE_FILE)
+
+# Bump BUNDLE_VERSION whenever the files in a bundle or the manifest change.
+BUNDLE_VERSION = 1
+
+
+def _package_version():
+    # importlib.metadata is slow to import and only needed to write a bundle.
+    from importlib.metadata import PackageNotFoundError, version
+
+    try:
+        return version("atol-reference-data-lookups")
+    except PackageNotFoundError:
+        return None
+
+
+def write_bundle(bundle_dir, index, name_index, reference_files):
+    """
+    Write index and name_index to bundle_dir with a manifest. The manifest
+    records the format versions, the name and checksum of each reference
+    file the index was built from, keyed as in index.checksums, and the
+    checksum of each file in the bundle.
+    """
+    bundle_dir = Path(bundle_dir)
+    Path.mkdir(bundle_dir, exist_ok=True, parents=True)
+    manifest_file = Path(bundle_dir, BUNDLE_MANIFEST)
+    manifest_file.unlink(missing_ok=True)
+
+    logger.info(f"Writing index bundle to {bundle_dir}")
+    index.save(Path(bundle_dir, INDEX_CACHE_FILE))
+    name_index.save(Path(bundle_dir, NAME_INDEX_CACHE_FILE))
+
+    manifest = {
+        "bundle_version": BUNDLE_VERSION,
+        "index_version": INDEX_VERSION,
+        "name_index_version": NAME_INDEX_VERSION,
+        "package_version": _package_version(),
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "inputs": {
+            key: {"file": Path(file_path).name, "sha256": index.checksums[key]}
+            for key, file_path in reference_files.items()
+        },
+        "files": {x: compute_sha256(Path(bundle_dir, x)) for x in BUNDLE_FILES},
+        "contents": {
+            "taxids": len(index),
+            "names": len(name_index),
+            "busco_datasets": len(index.busco_datasets),
+            "augustus_datasets": len(index.augustus_datasets),
+            "merged_taxids": len(index.merged_from),
+            "deleted_taxids": len(index.deleted),
+        },
+    }
+    with atomic_write(manifest_file) as tmp_file, open(tmp_file, "wt") as f:
+        json.dump(manifest, f, indent=2)
+        f.write("\n")
+    return manifest
+
+
+def read_manifest(bundle_dir):
+    """
+    Return the manifest of the bundle in bundle_dir. Raises ValueError if
+    there is no manifest or it is from another bundle version.
+    """
+    manifest_file = Path(bundle_dir, BUNDLE_MANIFEST)
+    try:
+        with open(manifest_file, "rt") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ValueError(f"Can't read index bundle manifest {manifest_file}: {e}")
+    if manifest.get("bundle_version") != BUNDLE_VERSION:
+        raise ValueError(
+            f"{bundle_dir} has bundle version {manifest.get('bundle_version')}, "
+            f"expected {BUNDLE_VERSION}"
+        )
+    return manifest
+
+
+def bundle_checksums(manifest):
+    """Return the reference file checksums in a manifest, as in index.checksums."""
+    return {key: x["sha256"] for key, x in manifest["inputs"].items()}
+
+
+def read_bundle(bundle_dir, verify=False):
+    """
+    Open the TaxonomyIndex in the bundle in bundle_dir. With verify, every
+    file in the bundle is hashed and checked against the manifest first.
+    Raises ValueError if the bundle is incomplete, from an incompatible
+    version or doesn't match its manifest.
+    """
+    manifest = read_manifest(bundle_dir)
+    if verify:
+        for name, checksum in manifest["files"].items():
+            if compute_sha256(Path(bundle_dir, name)) != checksum:
+                raise ValueError(
+                    f"{Path(bundle_dir, name)} doesn't match {BUNDLE_MANIFEST}"
+                )
+
+    logger.info(f"Reading taxonomy index from bundle {bundle_dir}")
+    index = TaxonomyIndex.load(Path(bundle_dir, INDEX_CACHE_FILE))
+    if index.checksums != bundle_checksums(manifest):
+        raise ValueError(
+            f"{Path(bundle_dir, INDEX_CACHE_FILE)} doesn't match {BUNDLE_MANIFEST}"
+        )
+    return index
+
+
+def read_bundle_name_index(bundle_dir, checksum):
+    """
+    Open the NameIndex in the bundle in bundle_dir. checksum identifies the
+    names.dmp it should have been built from.
+    """
+    logger.info(f"Reading name index from bundle {bundle_dir}")
+    name_index_file = Path(bundle_dir, NAME_INDEX_CACHE_FILE)
+    name_index = NameIndex.load(name_index_file)
+    if name_index.checksum != checksum:
+        raise ValueError(f"{name_index_file} doesn't match {BUNDLE_MANIFEST}")
+    return name_index
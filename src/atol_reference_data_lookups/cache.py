@@ -1,23 +1,269 @@
+import fcntl
 import hashlib
-import shelve
+import json
+import mmap
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 
+import numpy as np
+
 from atol_reference_data_lookups import logger
 
+# Binary array files start with the magic bytes, then a little-endian uint32
+# format version and a uint32 header length, then a JSON header. Each array
+# follows at an offset aligned to ARRAY_ALIGNMENT bytes. Bump
+# ARRAY_FILE_VERSION whenever the layout or the meaning of an array changes,
+# so that old caches are rebuilt instead of misread.
+ARRAY_FILE_MAGIC = b"ATOLIDX\0"
+ARRAY_FILE_VERSION = 1
+ARRAY_ALIGNMENT = 64
+_preamble = struct.Struct("<8sII")
+
+# Checksums computed during this run, keyed by resolved path, with the
+# fingerprint of the file when it was hashed, so that each reference file is
+# only hashed once unless it changes.
+_checksum_registry = {}
+
+# Checksums from earlier runs are kept in this file in the cache directory,
+# with the (size, mtime_ns, inode) fingerprint of the file when it was hashed.
+# A file whose fingerprint hasn't changed is not hashed again.
+FINGERPRINT_FILE = "fingerprints.json"
+
+HASH_BUFFER_SIZE = 8 * 1024 * 1024
+
+# tempfile.mkstemp creates files that only the owner can read. Files written
+# with atomic_write get the permissions from the umask instead, as with open,
+# so that a shared cache directory stays readable.
+_umask = os.umask(0)
+os.umask(_umask)
+
 
 def compute_sha256(file_path):
     logger.debug(f"Computing sha256 checksum for {file_path}.")
     sha256 = hashlib.sha256()
-    with open(file_path, "rb") as f:
-        for block in iter(lambda: f.read(4096), b""):
-            sha256.update(block)
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(file_path, "rb", buffering=0) as f:
+        while n_bytes := f.readinto(buffer):
+            sha256.update(view[:n_bytes])
     hex_digest = sha256.hexdigest()
     logger.debug(f"Checksum: {hex_digest}")
     return hex_digest
 
 
-def open_cache(cache_dir, name):
-    """Open a shelve cache file, ensuring the directory exists."""
-    cache_file = Path(cache_dir, name)
-    Path.mkdir(cache_file.parent, exist_ok=True, parents=True)
-    return cache_file
\ No newline at end of file
+def fingerprint(file_path):
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+def read_fingerprints(fingerprint_file):
+    try:
+        with open(fingerprint_file, "rt") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def update_fingerprints(fingerprint_file, entries):
+    """
+    Add entries to fingerprint_file. It is read again under the lock, so
+    entries that other processes added since are kept.
+    """
+    Path.mkdir(fingerprint_file.parent, exist_ok=True, parents=True)
+    with cache_lock(fingerprint_file):
+        fingerprints = read_fingerprints(fingerprint_file)
+        fingerprints.update(entries)
+        with atomic_write(fingerprint_file) as tmp_file, open(tmp_file, "wt") as f:
+            json.dump(fingerprints, f)
+
+
+def get_checksums(file_paths, cache_dir=None, verify=False):
+    """
+    Return a dict of the sha256 checksums of file_paths, which is a dict of
+    key to path.
+
+    With a cache_dir, files whose fingerprint matches the one stored there
+    are not hashed again. Otherwise, and for every file if verify is True,
+    the files are hashed in parallel.
+    """
+    fingerprint_file = None if cache_dir is None else Path(cache_dir, FINGERPRINT_FILE)
+    stored = {}
+    if fingerprint_file is not None:
+        stored = read_fingerprints(fingerprint_file)
+
+    checksums = {}
+    to_hash = {}
+    for key, file_path in file_paths.items():
+        resolved = str(Path(file_path).resolve())
+        current = fingerprint(resolved)
+        entry = None if verify else _checksum_registry.get(resolved)
+        if entry is not None and entry["fingerprint"] == current:
+            checksums[key] = entry["sha256"]
+            continue
+        entry = None if verify else stored.get(resolved)
+        if entry is not None and entry["fingerprint"] == current:
+            logger.debug(f"Fingerprint of {file_path} unchanged, not hashing")
+            checksums[key] = entry["sha256"]
+            _checksum_registry[resolved] = entry
+        else:
+            to_hash[key] = (resolved, current)
+
+    if not to_hash:
+        return checksums
+
+    logger.info(f"Computing checksums for {len(to_hash)} reference files")
+    hashed = {}
+    with ThreadPoolExecutor(max_workers=len(to_hash)) as executor:
+        digests = executor.map(compute_sha256, [x[0] for x in to_hash.values()])
+        for (key, (resolved, current)), digest in zip(to_hash.items(), digests):
+            checksums[key] = digest
+            hashed[resolved] = {"fingerprint": current, "sha256": digest}
+            _checksum_registry[resolved] = hashed[resolved]
+
+    if fingerprint_file is not None:
+        update_fingerprints(fingerprint_file, hashed)
+
+    return checksums
+
+
+def get_checksum(file_path):
+    """
+    Return the sha256 checksum of file_path, hashing it again only if it has
+    changed.
+    """
+    return get_checksums({"file": file_path})["file"]
+
+
+def clear_checksums():
+    """Forget the checksums computed so far, e.g. before checking for changes."""
+    _checksum_registry.clear()
+
+
+@contextmanager
+def cache_lock(cache_file):
+    """
+    Hold an exclusive advisory lock on cache_file while it is built, so that
+    processes sharing a cache directory build it one at a time. Waits for any
+    other process that holds the lock. Check the cache again once the lock is
+    held, because the other process may have built it.
+    """
+    lock_file = Path(f"{cache_file}.lock")
+    Path.mkdir(lock_file.parent, exist_ok=True, parents=True)
+    with open(lock_file, "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info(f"Waiting for another process to finish writing {cache_file}")
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def atomic_write(file_path):
+    """
+    Yield a temporary path next to file_path to write to. If the with block
+    succeeds, the temporary file is renamed to file_path, so readers never
+    see a partly written file. Otherwise it is removed. The temporary name is
+    unique, even between hosts that share the directory.
+    """
+    # tempfile is slow to import and only needed when a cache file is written.
+    import tempfile
+
+    file_path = Path(file_path)
+    fd, tmp_file = tempfile.mkstemp(
+        dir=file_path.parent, prefix=f"{file_path.name}.", suffix=".tmp"
+    )
+    tmp_file = Path(tmp_file)
+    try:
+        os.fchmod(fd, 0o666 & ~_umask)
+    finally:
+        os.close(fd)
+    try:
+        yield tmp_file
+        os.replace(tmp_file, file_path)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+
+
+def _aligned(offset):
+    return -(-offset // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+
+
+def write_array_file(file_path, arrays, metadata):
+    """
+    Write a dict of numpy arrays and a JSON-serialisable metadata dict to
+    file_path in the binary array format. The file is replaced atomically, so
+    processes that have the old file open keep a consistent view of it.
+    """
+    arrays = {name: np.ascontiguousarray(x) for name, x in arrays.items()}
+
+    # The array offsets depend on the header length, and the header records
+    # the offsets, so lay out the arrays relative to the end of the header
+    # and grow the header's reserved space until it fits.
+    reserved = ARRAY_ALIGNMENT
+    while True:
+        offset = _aligned(_preamble.size + reserved)
+        layout = {}
+        for name, x in arrays.items():
+            layout[name] = {"dtype": x.dtype.str, "offset": offset, "length": len(x)}
+            offset = _aligned(offset + x.nbytes)
+        header = json.dumps(
+            {"arrays": layout, "metadata": metadata}, separators=(",", ":")
+        ).encode()
+        if len(header) <= reserved:
+            break
+        reserved = _aligned(len(header))
+
+    with atomic_write(file_path) as tmp_file, open(tmp_file, "wb") as f:
+        f.write(_preamble.pack(ARRAY_FILE_MAGIC, ARRAY_FILE_VERSION, len(header)))
+        f.write(header)
+        for name, x in arrays.items():
+            f.seek(layout[name]["offset"])
+            f.write(x.data)
+        f.truncate(offset)
+
+
+def read_array_file(file_path):
+    """
+    Open a binary array file with mmap. Return a tuple of a dict of read-only
+    numpy arrays backed by the mapping, and the metadata dict.
+
+    Raises ValueError if the file is not a complete array file of the current
+    version.
+    """
+    with open(file_path, "rb") as f:
+        try:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ValueError(f"{file_path} is empty")
+
+    if len(buffer) < _preamble.size:
+        raise ValueError(f"{file_path} is truncated")
+    magic, version, header_length = _preamble.unpack_from(buffer)
+    if magic != ARRAY_FILE_MAGIC:
+        raise ValueError(f"{file_path} is not an array file")
+    if version != ARRAY_FILE_VERSION:
+        raise ValueError(
+            f"{file_path} has format version {version}, expected {ARRAY_FILE_VERSION}"
+        )
+
+    header_end = _preamble.size + header_length
+    if len(buffer) < header_end:
+        raise ValueError(f"{file_path} is truncated")
+    header = json.loads(buffer[_preamble.size : header_end])
+
+    arrays = {}
+    for name, layout in header["arrays"].items():
+        dtype = np.dtype(layout["dtype"])
+        if layout["offset"] + layout["length"] * dtype.itemsize > len(buffer):
+            raise ValueError(f"{file_path} is truncated")
+        arrays[name] = np.frombuffer(
+            buffer, dtype=dtype, count=layout["length"], offset=layout["offset"]
+        )
+    return arrays, header["metadata"]
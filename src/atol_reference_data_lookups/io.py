@@ -1,38 +1,161 @@
+import codecs
 import tarfile
 
 from atol_reference_data_lookups import logger
 
+# Compressed reference files are decoded in blocks of this many bytes.
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+def _check_null_bytes(text, n_lines, file_path):
+    if "\x00" in text:
+        i = n_lines + text[: text.index("\x00")].count("\n") + 1
+        raise ValueError(f"Null bytes at line {i} of {file_path}")
+
+
+def _read_lines(f, file_path):
+    """
+    Stream the lines of a binary file object, without line endings, decoding
+    UTF-8 in blocks. Raises ValueError if there are null bytes in the file.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    n_lines = 0
+    remainder = ""
+    while block := f.read(READ_BLOCK_SIZE):
+        text = remainder + decoder.decode(block)
+        _check_null_bytes(text, n_lines, file_path)
+        lines = text.split("\n")
+        remainder = lines.pop()
+        n_lines += len(lines)
+        for line in lines:
+            yield line.removesuffix("\r")
+    text = remainder + decoder.decode(b"", final=True)
+    _check_null_bytes(text, n_lines, file_path)
+    if text:
+        yield text.removesuffix("\r")
+
 
 def _extract_tarfile(file_path):
     with tarfile.open(file_path, "r:gz") as tar:
-        for member in tar.getmembers():
+        for member in tar:
             if member.isfile() and not member.name.startswith("."):
-                for line in tar.extractfile(member).read().decode().splitlines():
-                    yield line
+                with tar.extractfile(member) as f:
+                    yield from _read_lines(f, f"{file_path}:{member.name}")
 
 
 def read_gzip_textfile(file_path):
+    """
+    Stream the lines of a tar.gz, gzip or plain text file, without line
+    endings.
+    """
     file_string = file_path.as_posix()
     if file_string.endswith(".tar.gz") or file_string.endswith(".tgz"):
-        f = _extract_tarfile(file_path)
-    else:
+        yield from _extract_tarfile(file_path)
+        return
+    if file_string.endswith(".gz"):
         import gzip
 
-        f = gzip.open(file_path, "rt")
+        opener = gzip.open
+    else:
+        opener = open
+    with opener(file_path, "rb") as f:
+        yield from _read_lines(f, file_path)
+
+
+def read_taxdump_nodes(file_path):
+    """
+    Stream nodes.dmp, yielding one (tax_id, parent_tax_id, rank,
+    genetic_code_id, mitochondrial_genetic_code_id) tuple per node.
+    """
+    with open(file_path, "rt") as f:
+        for i, line in enumerate(f, 1):
+            # Only the first nine columns are needed. The split stops there,
+            # so the remaining columns are never separated.
+            fields = line.split("\t|\t", 9)
+            try:
+                yield (
+                    int(fields[0]),
+                    int(fields[1]),
+                    fields[2],
+                    int(fields[6]),
+                    int(fields[8]),
+                )
+            except (IndexError, ValueError):
+                raise ValueError(
+                    f"Invalid taxdump nodes format at line {i} of {file_path}"
+                )
 
-    for i, line in enumerate(f, 1):
-        if "\x00" in line:
-            raise ValueError(f"Null bytes at line {i} of {file_path}")
-        yield line
+
+def read_taxdump_names(file_path):
+    """
+    Stream names.dmp, yielding one (tax_id, name_txt, unique_name, name_class)
+    tuple per name. unique_name is an empty string for most names.
+    """
+    with open(file_path, "rt") as f:
+        for i, line in enumerate(f, 1):
+            fields = line.rstrip("\n").removesuffix("\t|").split("\t|\t")
+            try:
+                yield (int(fields[0]), fields[1], fields[2], fields[3])
+            except (IndexError, ValueError):
+                raise ValueError(
+                    f"Invalid taxdump names format at line {i} of {file_path}"
+                )
+
+
+def read_taxdump_merged(file_path):
+    """Stream merged.dmp, yielding one (old_tax_id, new_tax_id) tuple per line."""
+    with open(file_path, "rt") as f:
+        for i, line in enumerate(f, 1):
+            fields = line.split("\t|", 2)
+            try:
+                yield (int(fields[0]), int(fields[1]))
+            except (IndexError, ValueError):
+                raise ValueError(
+                    f"Invalid taxdump merged format at line {i} of {file_path}"
+                )
+
+
+def read_taxdump_delnodes(file_path):
+    """Stream delnodes.dmp, yielding one deleted tax_id per line."""
+    with open(file_path, "rt") as f:
+        for i, line in enumerate(f, 1):
+            try:
+                yield int(line.split("\t|", 1)[0])
+            except ValueError:
+                raise ValueError(
+                    f"Invalid taxdump delnodes format at line {i} of {file_path}"
+                )
 
 
 def read_busco_mapping(taxids_to_busco_dataset_mapping):
-    dataset_mapping = read_gzip_textfile(taxids_to_busco_dataset_mapping)
-    next(dataset_mapping)  # skip the header
+    """
+    Read one BUSCO placement file, or a list of them, e.g. for eukaryota,
+    bacteria and archaea, into one dict of taxid to dataset name. If the files
+    map the same taxid to different datasets, the last file wins.
+    """
+    if isinstance(taxids_to_busco_dataset_mapping, (list, tuple)):
+        file_paths = taxids_to_busco_dataset_mapping
+    else:
+        file_paths = [taxids_to_busco_dataset_mapping]
+
     taxid_to_dataset = {}
-    for mapping in dataset_mapping:
-        splits = mapping.strip().split(maxsplit=1)
-        taxid_to_dataset[int(splits[0])] = str(splits[1])
+    for file_path in file_paths:
+        dataset_mapping = read_gzip_textfile(file_path)
+        next(dataset_mapping)  # skip the header
+        n_replaced = 0
+        for mapping in dataset_mapping:
+            splits = mapping.strip().split(maxsplit=1)
+            if not splits:
+                continue
+            taxid = int(splits[0])
+            dataset = str(splits[1])
+            if taxid_to_dataset.get(taxid, dataset) != dataset:
+                n_replaced += 1
+            taxid_to_dataset[taxid] = dataset
+        if n_replaced > 0:
+            logger.info(
+                f"{file_path} replaced the BUSCO dataset of {n_replaced} taxids"
+            )
     logger.debug(taxid_to_dataset)
     return taxid_to_dataset
 
@@ -44,4 +167,4 @@ def read_augustus_mapping(taxids_to_augustus_dataset_mapping):
             splits = line.strip().split(maxsplit=1)
             taxid_to_dataset[int(splits[0])] = str(splits[1])
     logger.debug(taxid_to_dataset)
-    return taxid_to_dataset
\ No newline at end of file
+    return taxid_to_dataset
@@ -0,0 +1,82 @@
+import json
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+from atol_reference_data_lookups import logger
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Metrics:
+    """
+    Collects the wall time, CPU time and peak RSS of each phase of a run, and
+    whether each cached artefact was a hit or a miss. Recording is cheap, so
+    metrics are always collected and only written out if asked for.
+    """
+
+    def __init__(self):
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.phases = []
+        self.caches = {}
+        self.counters = {}
+
+    @contextmanager
+    def phase(self, name):
+        """Time the code in the with block as the phase name."""
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall_seconds = time.perf_counter() - start_wall
+            self.phases.append(
+                {
+                    "name": name,
+                    "wall_seconds": wall_seconds,
+                    "cpu_seconds": time.process_time() - start_cpu,
+                    "peak_rss_mb": peak_rss_mb(),
+                }
+            )
+            logger.debug(f"Phase {name} took {wall_seconds:.3f}s")
+
+    def cache(self, artefact, hit):
+        """Record whether the cached artefact was a hit or a miss."""
+        self.caches[artefact] = "hit" if hit else "miss"
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_dict(self):
+        wall_seconds = time.perf_counter() - self.start_wall
+        metrics = {
+            "wall_seconds": wall_seconds,
+            "cpu_seconds": time.process_time() - self.start_cpu,
+            "peak_rss_mb": peak_rss_mb(),
+            "phases": self.phases,
+            "caches": self.caches,
+            "counters": self.counters,
+        }
+        lookup_seconds = sum(
+            x["wall_seconds"] for x in self.phases if x["name"] == "lookups"
+        )
+        if self.counters.get("queries") and lookup_seconds > 0:
+            metrics["queries_per_second"] = self.counters["queries"] / lookup_seconds
+        return metrics
+
+    def write(self, file_path):
+        """Write the metrics as JSON to file_path, or to stderr if it is -."""
+        if str(file_path) == "-":
+            sys.stderr.write(json.dumps(self.to_dict()))
+            sys.stderr.write("\n")
+        else:
+            with open(file_path, "wt") as f:
+                json.dump(self.to_dict(), f, indent=2)
+
+
+metrics = Metrics()
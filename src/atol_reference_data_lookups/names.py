@@ -0,0 +1,248 @@
+import zlib
+
+import numpy as np
+
+from atol_reference_data_lookups import logger
+from atol_reference_data_lookups.cache import read_array_file, write_array_file
+
+# Name classes from names.dmp that are indexed, in order of preference when a
+# name matches several taxids. The other classes (authority, type material,
+# includes, in-part) name strains, authors or parts of other taxa, not the
+# taxon itself.
+NAME_CLASSES = (
+    "scientific name",
+    "equivalent name",
+    "synonym",
+    "genbank common name",
+    "common name",
+    "blast name",
+    "genbank acronym",
+    "acronym",
+)
+_class_codes = {x: i for i, x in enumerate(NAME_CLASSES)}
+
+# Value returned for names that are not in the index, or that match more than
+# one taxid.
+NOT_FOUND = -1
+AMBIGUOUS = -2
+
+# Bump NAME_INDEX_VERSION whenever the arrays stored in the index change, so
+# that cached name indexes from older versions are rebuilt.
+NAME_INDEX_VERSION = 1
+
+
+def fold_name(name):
+    """Return the key that names are compared by without case."""
+    return name.strip().casefold().encode()
+
+
+def _hash_keys(keys):
+    return np.fromiter((zlib.crc32(x) for x in keys), dtype=np.uint32, count=len(keys))
+
+
+class NameIndex:
+    """
+    Compact index of the names in names.dmp.
+
+    Names are stored as one UTF-8 byte array with offsets, sorted by their
+    case-folded form, so prefix searches are a binary search. Exact lookups
+    go through a sorted array of the crc32 hashes of the folded names, so a
+    batch of names is resolved with one searchsorted call.
+
+    Like TaxonomyIndex, the index is cached as a binary array file and opened
+    with mmap.
+    """
+
+    # Arrays that are written to and read from the cache file.
+    array_names = (
+        "name_data",
+        "name_offsets",
+        "name_taxids",
+        "name_class",
+        "name_hash",
+        "hash_order",
+    )
+
+    def __init__(
+        self, name_data, name_offsets, name_taxids, name_class, name_hash, hash_order
+    ):
+        self.name_data = name_data
+        self.name_offsets = name_offsets
+        self.name_taxids = name_taxids
+        self.name_class = name_class
+        self.name_hash = name_hash
+        self.hash_order = hash_order
+        self.checksum = None
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Build the index from (tax_id, name, unique_name, name_class) records,
+        e.g. from io.read_taxdump_names. Unique names are indexed as well as
+        names, so homonyms can be looked up by their unique name.
+        """
+        best_class = {}
+        for taxid, name, unique_name, name_class in records:
+            class_code = _class_codes.get(name_class)
+            if class_code is None:
+                continue
+            for x in (name, unique_name):
+                if x:
+                    key = (x, taxid)
+                    best_class[key] = min(best_class.get(key, class_code), class_code)
+
+        entries = sorted(
+            (fold_name(name), class_code, taxid, name.encode())
+            for (name, taxid), class_code in best_class.items()
+        )
+        logger.debug(f"Indexing {len(entries)} names")
+
+        lengths = np.fromiter(
+            (len(x[3]) for x in entries), dtype=np.int64, count=len(entries)
+        )
+        name_offsets = np.zeros(len(entries) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=name_offsets[1:])
+        name_data = np.frombuffer(b"".join(x[3] for x in entries), dtype=np.uint8)
+        name_taxids = np.fromiter(
+            (x[2] for x in entries), dtype=np.int32, count=len(entries)
+        )
+        name_class = np.fromiter(
+            (x[1] for x in entries), dtype=np.uint8, count=len(entries)
+        )
+
+        hashes = _hash_keys([x[0] for x in entries])
+        hash_order = np.argsort(hashes, kind="stable").astype(np.int32)
+        return cls(
+            name_data,
+            name_offsets,
+            name_taxids,
+            name_class,
+            hashes[hash_order],
+            hash_order,
+        )
+
+    @classmethod
+    def load(cls, file_path):
+        """
+        Open a cached name index. Raises ValueError if the file is not a valid
+        name index of the current format version.
+        """
+        arrays, metadata = read_array_file(file_path)
+        if metadata.get("name_index_version") != NAME_INDEX_VERSION:
+            raise ValueError(
+                f"{file_path} has name index version "
+                f"{metadata.get('name_index_version')}, expected {NAME_INDEX_VERSION}"
+            )
+        try:
+            index = cls(*(arrays[x] for x in cls.array_names))
+        except KeyError as e:
+            raise ValueError(f"{file_path} is missing {e}")
+        index.checksum = metadata.get("checksum")
+        return index
+
+    def save(self, file_path):
+        write_array_file(
+            file_path,
+            {x: getattr(self, x) for x in self.array_names},
+            {"name_index_version": NAME_INDEX_VERSION, "checksum": self.checksum},
+        )
+
+    def __len__(self):
+        return len(self.name_taxids)
+
+    def name(self, i):
+        """Return the i-th name, in sorted order."""
+        start, end = self.name_offsets[i], self.name_offsets[i + 1]
+        return self.name_data[start:end].tobytes().decode()
+
+    def _entry(self, i):
+        return (
+            self.name(i),
+            int(self.name_taxids[i]),
+            NAME_CLASSES[self.name_class[i]],
+        )
+
+    def _matches(self, query, query_hash):
+        """Return the positions of the names that fold to the same key as query."""
+        key = fold_name(query)
+        start = np.searchsorted(self.name_hash, query_hash, side="left")
+        end = np.searchsorted(self.name_hash, query_hash, side="right")
+        return [
+            int(i) for i in self.hash_order[start:end] if fold_name(self.name(i)) == key
+        ]
+
+    def find(self, name, case_sensitive=False):
+        """
+        Return every (name, taxid, name_class) that matches name, with or
+        without case.
+        """
+        positions = self._matches(name, _hash_keys([fold_name(name)])[0])
+        entries = [self._entry(i) for i in positions]
+        if case_sensitive:
+            entries = [x for x in entries if x[0] == name.strip()]
+        return entries
+
+    def resolve_many(self, names, case_sensitive=False):
+        """
+        Resolve many names to taxids at once. Returns an int64 array with the
+        taxid of each name, NOT_FOUND for names that are not in the index, and
+        AMBIGUOUS for names that match more than one taxid.
+
+        A name that matches with the same case is preferred over one that
+        only matches without case, and scientific names are preferred over
+        other name classes.
+        """
+        names = list(names)
+        keys = [fold_name(x) for x in names]
+        query_hashes = _hash_keys(keys)
+        starts = np.searchsorted(self.name_hash, query_hashes, side="left")
+        ends = np.searchsorted(self.name_hash, query_hashes, side="right")
+
+        taxids = np.full(len(names), NOT_FOUND, dtype=np.int64)
+        for i in np.flatnonzero(ends > starts):
+            name = names[i].strip()
+            matches = [
+                int(j)
+                for j in self.hash_order[starts[i] : ends[i]]
+                if fold_name(self.name(j)) == keys[i]
+            ]
+            same_case = [j for j in matches if self.name(j) == name]
+            if case_sensitive or same_case:
+                matches = same_case
+            if not matches:
+                continue
+            best_class = min(self.name_class[j] for j in matches)
+            candidates = {
+                int(self.name_taxids[j])
+                for j in matches
+                if self.name_class[j] == best_class
+            }
+            taxids[i] = candidates.pop() if len(candidates) == 1 else AMBIGUOUS
+        return taxids
+
+    def _search_prefix(self, key):
+        """Return the position of the first name whose folded key is >= key."""
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if fold_name(self.name(middle)) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def search_prefix(self, prefix, limit=None):
+        """
+        Return (name, taxid, name_class) for every name that starts with
+        prefix, ignoring case, in sorted order. Returns at most limit names.
+        """
+        key = fold_name(prefix)
+        entries = []
+        i = self._search_prefix(key)
+        while i < len(self) and (limit is None or len(entries) < limit):
+            entry = self._entry(i)
+            if not fold_name(entry[0]).startswith(key):
+                break
+            entries.append(entry)
+            i += 1
+        return entries
@@ -0,0 +1,207 @@
+import csv
+import json
+import sys
+from contextlib import contextmanager
+
+# Output formats that are written one batch of records at a time, while the
+# lookups run. json is written once all the lookups are done.
+STREAMING_FORMATS = ("ndjson", "tsv", "parquet", "arrow")
+
+# Output formats that need pyarrow.
+ARROW_FORMATS = ("parquet", "arrow")
+
+# Columns that are written as dictionary encoded strings in Parquet and Arrow
+# output, so that each distinct name is only stored once per batch.
+DICTIONARY_COLUMNS = (
+    "busco_dataset_name",
+    "augustus_dataset_name",
+    "taxid_status",
+    "rank",
+)
+
+# Types of the columns in Parquet and Arrow output, as pyarrow type aliases.
+COLUMN_TYPES = {
+    "taxid": "int64",
+    "name": "string",
+    "busco_dataset_name": "string",
+    "augustus_dataset_name": "string",
+    "genetic_code_id": "uint8",
+    "mitochondrial_genetic_code_id": "uint8",
+    "resolved_taxid": "int64",
+    "taxid_status": "string",
+    "taxid_a": "int64",
+    "taxid_b": "int64",
+    "lca": "int64",
+    "distance": "int64",
+    "rank": "string",
+    "count": "int64",
+    "in_clade": "bool",
+}
+
+# Columns of each kind of record. The writers take them up front, so that
+# output without any records still has a header or schema.
+LOOKUP_COLUMNS = (
+    "taxid",
+    "busco_dataset_name",
+    "augustus_dataset_name",
+    "genetic_code_id",
+    "mitochondrial_genetic_code_id",
+    "resolved_taxid",
+    "taxid_status",
+)
+NAME_LOOKUP_COLUMNS = ("name", *LOOKUP_COLUMNS)
+PAIR_COLUMNS = ("taxid_a", "taxid_b", "lca", "distance")
+DESCENDANT_COLUMNS = ("taxid", "rank")
+RANK_SUMMARY_COLUMNS = ("taxid", "rank", "count")
+IN_CLADE_COLUMNS = ("taxid", "in_clade")
+
+
+class NdjsonWriter:
+    """Writes each record as one line of JSON."""
+
+    def __init__(self, f, columns):
+        self.f = f
+
+    def write(self, rows):
+        for row in rows:
+            self.f.write(json.dumps(row))
+            self.f.write("\n")
+        self.f.flush()
+
+    def close(self):
+        self.f.flush()
+
+
+class TsvWriter:
+    """
+    Writes records as tab-separated values, with a header row of columns.
+    Missing values are written as empty fields.
+    """
+
+    def __init__(self, f, columns):
+        self.f = f
+        self.writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        self.columns = list(columns)
+        self.writer.writerow(self.columns)
+
+    def write(self, rows):
+        if not rows:
+            return
+        self.writer.writerows([row[x] for x in self.columns] for row in rows)
+        self.f.flush()
+
+    def close(self):
+        self.f.flush()
+
+
+class _TrackedBinaryFile:
+    """
+    Wraps a binary file and counts the bytes written to it. pyarrow asks for
+    the position of the output while writing, which pipes like Standard
+    Output can't report themselves.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        n_bytes = self.f.write(data)
+        self.position += n_bytes
+        return n_bytes
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        # The wrapped file belongs to the caller, so it is only flushed.
+        self.f.flush()
+        self.closed = True
+
+
+class ArrowWriter:
+    """
+    Writes records as Parquet, with one row group per batch, or as an Arrow
+    IPC stream, with one record batch per batch. Dataset names and other
+    repeated strings are dictionary encoded, and TaxIds and genetic codes are
+    integer columns. The schema comes from columns and COLUMN_TYPES.
+    """
+
+    def __init__(self, f, output_format, columns):
+        import pyarrow
+
+        self.pa = pyarrow
+        self.f = pyarrow.PythonFile(_TrackedBinaryFile(f), mode="w")
+        self.output_format = output_format
+        fields = []
+        for name in columns:
+            column_type = pyarrow.type_for_alias(COLUMN_TYPES[name])
+            if name in DICTIONARY_COLUMNS:
+                column_type = pyarrow.dictionary(pyarrow.int32(), column_type)
+            fields.append(pyarrow.field(name, column_type))
+        self.schema = pyarrow.schema(fields)
+        self.writer = None
+
+    def _batch(self, rows):
+        pa = self.pa
+        arrays = []
+        for field in self.schema:
+            values = [row[field.name] for row in rows]
+            if pa.types.is_dictionary(field.type):
+                array = pa.array(values, type=field.type.value_type)
+                array = array.dictionary_encode()
+            else:
+                array = pa.array(values, type=field.type)
+            arrays.append(array)
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def _open(self):
+        if self.output_format == "parquet":
+            import pyarrow.parquet
+
+            self.writer = pyarrow.parquet.ParquetWriter(self.f, self.schema)
+        else:
+            self.writer = self.pa.ipc.new_stream(self.f, self.schema)
+
+    def write(self, rows):
+        if not rows:
+            return
+        batch = self._batch(rows)
+        if self.writer is None:
+            self._open()
+        if self.output_format == "parquet":
+            self.writer.write_table(self.pa.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+
+    def close(self):
+        # Without any records, this still writes a file with the schema.
+        if self.writer is None:
+            self._open()
+        self.writer.close()
+        self.f.flush()
+
+
+@contextmanager
+def open_writer(output_format, columns):
+    """
+    Open a writer for one of the STREAMING_FORMATS on Standard Output. Pass
+    lists of records, as dicts with columns as keys, to its write method.
+    """
+    if output_format == "ndjson":
+        writer = NdjsonWriter(sys.stdout, columns)
+    elif output_format == "tsv":
+        writer = TsvWriter(sys.stdout, columns)
+    elif output_format in ARROW_FORMATS:
+        sys.stdout.flush()
+        writer = ArrowWriter(sys.stdout.buffer, output_format, columns)
+    else:
+        raise ValueError(f"Can't stream output format {output_format}")
+    try:
+        yield writer
+    finally:
+        writer.close()
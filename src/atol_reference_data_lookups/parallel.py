@@ -0,0 +1,105 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from atol_reference_data_lookups import logger
+from atol_reference_data_lookups.index import TaxonomyIndex, as_taxid_array
+
+# The index each worker process looks up taxids in. Workers open the cached
+# index file with mmap, so they share one copy of it through the page cache.
+_worker_index = None
+
+
+def _init_worker(index_file, checksums):
+    global _worker_index
+    index = TaxonomyIndex.load(index_file)
+    # The file could have been replaced since the parent process checked it.
+    if index.checksums != checksums:
+        raise ValueError(
+            f"{index_file} doesn't match the reference data the lookups were "
+            "started with"
+        )
+    _worker_index = index
+
+
+def _lookup_ndjson(taxids):
+    results = _worker_index.lookup_many(taxids)
+    return results.to_ndjson(), results.counts()
+
+
+def _lookup_json(taxids, first_seen):
+    # Every query is counted, but each taxid is only output where it was
+    # first seen, as it would be in a dict.
+    results = _worker_index.lookup_many(taxids)
+    return results.take(first_seen).to_json_members(), results.counts()
+
+
+class LookupPool:
+    """
+    Process pool for looking up taxids and formatting the output in parallel.
+    Results are returned in input order.
+
+    index_file is the cached TaxonomyIndex, which must already be up to date.
+    checksums are the expected TaxonomyIndex.checksums of index_file, and the
+    workers fail to start if it doesn't have them.
+    """
+
+    def __init__(self, index_file, workers, checksums):
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(str(index_file), checksums),
+        )
+        logger.info(f"Started {workers} lookup workers")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown(cancel_futures=True)
+
+    def map_ndjson(self, chunks):
+        """
+        Look up each chunk of taxids. Yields a tuple of the NDJSON output and
+        the LookupResults.counts for each chunk, in order.
+
+        Only a few chunks per worker are in flight at once, so chunks can be
+        streamed from a file of any length.
+        """
+        pending = deque()
+        for chunk in chunks:
+            taxids = as_taxid_array(chunk)
+            pending.append(self.executor.submit(_lookup_ndjson, taxids))
+            if len(pending) >= 2 * self.workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def lookup_json(self, taxids):
+        """
+        Look up taxids, sharded across the workers. Returns a tuple of the
+        output as a JSON object keyed by taxid, and the LookupResults.counts
+        summed over all the taxids.
+        """
+        taxids = as_taxid_array(taxids)
+        first_seen = np.zeros(len(taxids), dtype=bool)
+        first_seen[np.unique(taxids, return_index=True)[1]] = True
+
+        futures = [
+            self.executor.submit(_lookup_json, shard, shard_first_seen)
+            for shard, shard_first_seen in zip(
+                np.array_split(taxids, self.workers),
+                np.array_split(first_seen, self.workers),
+            )
+        ]
+        members = []
+        counts = {}
+        for future in futures:
+            shard_members, shard_counts = future.result()
+            if shard_members:
+                members.append(shard_members)
+            for key, n in shard_counts.items():
+                counts[key] = counts.get(key, 0) + n
+        return "{" + ", ".join(members) + "}", counts
@@ -0,0 +1,155 @@
+import json
+
+import numpy as np
+
+# Status of a query taxid. Status codes index into TAXID_STATUSES.
+TAXID_STATUSES = ("current", "merged", "deleted", "unknown")
+CURRENT, MERGED, DELETED, UNKNOWN = range(len(TAXID_STATUSES))
+
+
+class LookupResults:
+    """
+    Columnar results of a batch lookup, one row per query taxid in input
+    order.
+
+    Dataset names are dictionary encoded: busco_code and augustus_code index
+    into busco_datasets and augustus_datasets, and -1 means no dataset. Rows
+    for taxids that are not in the taxonomy have found set to False, and their
+    other columns should be ignored.
+
+    Merged taxids are looked up as the taxid they were merged into, which is
+    in resolved_taxids. status is a code into TAXID_STATUSES for each query.
+    """
+
+    def __init__(
+        self,
+        taxids,
+        resolved_taxids,
+        status,
+        found,
+        busco_code,
+        busco_datasets,
+        augustus_code,
+        augustus_datasets,
+        genetic_code,
+        mito_code,
+    ):
+        self.taxids = taxids
+        self.resolved_taxids = resolved_taxids
+        self.status = status
+        self.found = found
+        self.busco_code = busco_code
+        self.busco_datasets = list(busco_datasets)
+        self.augustus_code = augustus_code
+        self.augustus_datasets = list(augustus_datasets)
+        self.genetic_code = genetic_code
+        self.mito_code = mito_code
+
+    def __len__(self):
+        return len(self.taxids)
+
+    def take(self, rows):
+        """Return the results for rows, an index or boolean mask array."""
+        return LookupResults(
+            self.taxids[rows],
+            self.resolved_taxids[rows],
+            self.status[rows],
+            self.found[rows],
+            self.busco_code[rows],
+            self.busco_datasets,
+            self.augustus_code[rows],
+            self.augustus_datasets,
+            self.genetic_code[rows],
+            self.mito_code[rows],
+        )
+
+    @property
+    def missing_taxids(self):
+        """Taxids that are neither in the taxonomy nor deleted."""
+        return self.taxids[self.status == UNKNOWN]
+
+    @property
+    def merged_taxids(self):
+        return self.taxids[self.status == MERGED]
+
+    @property
+    def deleted_taxids(self):
+        return self.taxids[self.status == DELETED]
+
+    @property
+    def taxid_status(self):
+        return np.array(TAXID_STATUSES, dtype=object)[self.status]
+
+    def counts(self):
+        """Return the number of queries, and of missing, merged and deleted ones."""
+        return {
+            "queries": len(self),
+            "missing_taxids": int(np.count_nonzero(self.status == UNKNOWN)),
+            "merged_taxids": int(np.count_nonzero(self.status == MERGED)),
+            "deleted_taxids": int(np.count_nonzero(self.status == DELETED)),
+        }
+
+    @staticmethod
+    def _decode(codes, datasets):
+        # The extra None at the end is picked up by codes of -1.
+        return np.array(datasets + [None], dtype=object)[codes]
+
+    @property
+    def busco_dataset_name(self):
+        return self._decode(self.busco_code, self.busco_datasets)
+
+    @property
+    def augustus_dataset_name(self):
+        return self._decode(self.augustus_code, self.augustus_datasets)
+
+    def records(self):
+        """
+        Yield a (taxid, result) tuple for each found or deleted row, where
+        result is a dict in the format of the JSON output. Deleted taxids have
+        no datasets or genetic codes.
+        """
+        rows = np.flatnonzero(self.status != UNKNOWN)
+        columns = zip(
+            self.taxids[rows].tolist(),
+            self.found[rows].tolist(),
+            self.resolved_taxids[rows].tolist(),
+            self.taxid_status[rows].tolist(),
+            self.busco_dataset_name[rows].tolist(),
+            self.augustus_dataset_name[rows].tolist(),
+            self.genetic_code[rows].tolist(),
+            self.mito_code[rows].tolist(),
+        )
+        for taxid, found, resolved, status, busco, augustus, *codes in columns:
+            genetic_code, mito_code = codes if found else (None, None)
+            yield (
+                taxid,
+                {
+                    "busco_dataset_name": busco,
+                    "augustus_dataset_name": augustus,
+                    "genetic_code_id": genetic_code,
+                    "mitochondrial_genetic_code_id": mito_code,
+                    "resolved_taxid": resolved if found else None,
+                    "taxid_status": status,
+                },
+            )
+
+    def to_dict(self):
+        """Return the found rows as a dict of taxid to result."""
+        return dict(self.records())
+
+    def to_ndjson(self):
+        """Return the records as NDJSON, one line per record."""
+        return "".join(
+            json.dumps({"taxid": taxid, **result}) + "\n"
+            for taxid, result in self.records()
+        )
+
+    def to_json_members(self):
+        """
+        Return the records as the members of a JSON object keyed by taxid,
+        without the enclosing braces, formatted as json.dump would.
+        """
+        return ", ".join(
+            f"{json.dumps(str(taxid))}: {json.dumps(result)}"
+            for taxid, result in self.records()
+        )
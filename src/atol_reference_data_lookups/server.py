@@ -0,0 +1,306 @@
+import http.client
+import json
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import parse_qs, urlsplit
+
+from atol_reference_data_lookups import logger
+from atol_reference_data_lookups.bundle import bundle_checksums, read_manifest
+from atol_reference_data_lookups.cache import clear_checksums, get_checksums
+
+
+def parse_address(address):
+    """
+    Parse a server address. unix:/path/to/socket is a Unix domain socket,
+    anything else is host:port or just a port on localhost.
+    """
+    if address.startswith("unix:"):
+        return ("unix", address.removeprefix("unix:"))
+    host, _, port = address.rpartition(":")
+    return ("tcp", (host or "127.0.0.1", int(port)))
+
+
+# Taxids are looked up as 64-bit integers.
+MAX_TAXID = 2**63 - 1
+
+
+def parse_taxids(values):
+    """
+    Return values as a list of int taxids. Raises ValueError if any value is
+    not an integer, or is too big to be looked up.
+    """
+    taxids = [int(x) for x in values]
+    for taxid in taxids:
+        if not -MAX_TAXID - 1 <= taxid <= MAX_TAXID:
+            raise ValueError(f"TaxId {taxid} is out of range")
+    return taxids
+
+
+def results_to_response(results):
+    return {
+        "results": [{"taxid": taxid, **result} for taxid, result in results.records()],
+        "missing_taxids": results.missing_taxids.tolist(),
+        "merged_taxids": results.merged_taxids.tolist(),
+        "deleted_taxids": results.deleted_taxids.tolist(),
+    }
+
+
+class LookupService:
+    """
+    Holds the loaded TaxdumpTree for the server, and replaces it when the
+    reference data changes.
+
+    load_taxdump_tree is a callable that returns a new TaxdumpTree.
+    reference_files is a dict of the paths whose checksums are recorded in the
+    index, with the same keys as the index's checksums. With index_bundle, the
+    tree is loaded from that bundle, and it is reloaded when the bundle is
+    replaced with one built from other reference files.
+    """
+
+    def __init__(
+        self, load_taxdump_tree, reference_files, cache_dir, index_bundle=None
+    ):
+        self.load_taxdump_tree = load_taxdump_tree
+        self.reference_files = reference_files
+        self.cache_dir = cache_dir
+        self.index_bundle = index_bundle
+        self.taxdump_tree = None
+        # Message of the exception that stopped the reference data loading,
+        # if it failed.
+        self.error = None
+        self.reload_lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.taxdump_tree is not None
+
+    def load(self):
+        """
+        Load the TaxdumpTree. If it fails, the error is kept so that /ready
+        and /lookup can report it, instead of the server loading forever.
+        """
+        with self.reload_lock:
+            try:
+                self.taxdump_tree = self.load_taxdump_tree()
+            except Exception as e:
+                logger.error(f"Failed to load reference data: {e}")
+                self.error = str(e)
+                return
+            self.error = None
+        logger.info("Ready for lookups")
+
+    def reference_changed(self):
+        if self.index_bundle is not None:
+            checksums = bundle_checksums(read_manifest(self.index_bundle))
+            return checksums != self.taxdump_tree.index.checksums
+        clear_checksums()
+        checksums = get_checksums(self.reference_files, self.cache_dir)
+        return checksums != self.taxdump_tree.index.checksums
+
+    def reload(self):
+        """
+        Reload the TaxdumpTree if any reference file has changed, or if the
+        first load failed. Lookups keep using the old tree until the new one
+        is ready, and if the reload fails. Returns True if the tree was
+        reloaded, or None if a reload is already running. Exceptions are
+        logged and raised.
+        """
+        if not self.reload_lock.acquire(blocking=False):
+            return None
+        try:
+            if self.taxdump_tree is not None and not self.reference_changed():
+                logger.info("Reference data unchanged, not reloading")
+                return False
+            logger.info("Reloading reference data")
+            taxdump_tree = self.load_taxdump_tree()
+        except Exception as e:
+            logger.error(f"Failed to reload reference data: {e}")
+            if self.taxdump_tree is None:
+                self.error = str(e)
+            raise
+        else:
+            self.taxdump_tree = taxdump_tree
+            self.error = None
+            logger.info("Reloaded reference data")
+            return True
+        finally:
+            self.reload_lock.release()
+
+    def lookup(self, taxids):
+        return results_to_response(self.taxdump_tree.lookup_many(taxids))
+
+
+class LookupRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /health       200 while the server is running
+    GET /ready        200 once the reference data is loaded, 500 if loading
+                      failed, otherwise 503
+    GET /lookup       look up the taxid query parameters, e.g. ?taxid=9606
+    POST /lookup      look up a JSON list of taxids
+    POST /reload      reload the reference data if it has changed, or if
+                      loading failed. 500 if the reload fails.
+    """
+
+    server_version = "atol-reference-data-lookups"
+
+    def address_string(self):
+        # Unix domain socket clients don't have a (host, port) address.
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return "unix"
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        service = self.server.service
+        if url.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        elif url.path == "/ready":
+            if service.ready:
+                self.send_json(200, {"status": "ready"})
+            elif service.error is not None:
+                self.send_json(500, {"status": "failed", "error": service.error})
+            else:
+                self.send_json(503, {"status": "loading"})
+        elif url.path == "/lookup":
+            try:
+                taxids = parse_taxids(parse_qs(url.query).get("taxid", []))
+            except ValueError as e:
+                self.send_json(400, {"error": str(e)})
+                return
+            self.send_lookup(taxids)
+        else:
+            self.send_json(404, {"error": f"Unknown path {url.path}"})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        service = self.server.service
+        if url.path == "/lookup":
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                taxids = parse_taxids(json.loads(self.rfile.read(length)))
+            except (TypeError, ValueError) as e:
+                self.send_json(400, {"error": str(e)})
+                return
+            self.send_lookup(taxids)
+        elif url.path == "/reload":
+            if not service.ready and service.error is None:
+                self.send_json(503, {"status": "loading"})
+                return
+            try:
+                reloaded = service.reload()
+            except Exception as e:
+                self.send_json(500, {"error": str(e)})
+                return
+            if reloaded is None:
+                self.send_json(409, {"error": "A reload is already running"})
+            else:
+                self.send_json(200, {"reloaded": reloaded})
+        else:
+            self.send_json(404, {"error": f"Unknown path {url.path}"})
+
+    def send_lookup(self, taxids):
+        service = self.server.service
+        if not service.ready:
+            if service.error is not None:
+                self.send_json(500, {"status": "failed", "error": service.error})
+            else:
+                self.send_json(503, {"status": "loading"})
+            return
+        try:
+            response = service.lookup(taxids)
+        except Exception as e:
+            logger.error(f"Lookup failed: {e}")
+            self.send_json(500, {"error": str(e)})
+            return
+        self.send_json(200, response)
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(address, service):
+    """
+    Serve lookups on address until interrupted. The socket is bound before
+    the reference data is loaded, so clients can poll /ready.
+    """
+    kind, bind_address = parse_address(address)
+    if kind == "unix":
+        Path(bind_address).unlink(missing_ok=True)
+        server = UnixHTTPServer(bind_address, LookupRequestHandler)
+    else:
+        server = ThreadingHTTPServer(bind_address, LookupRequestHandler)
+    server.service = service
+    logger.info(f"Listening on {address}")
+
+    threading.Thread(target=service.load, daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down")
+    finally:
+        server.server_close()
+        if kind == "unix":
+            Path(bind_address).unlink(missing_ok=True)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request(address, method, path, data=None):
+    """Send a request to a lookup server and return the decoded JSON reply."""
+    kind, connect_address = parse_address(address)
+    if kind == "unix":
+        connection = UnixHTTPConnection(connect_address)
+    else:
+        connection = http.client.HTTPConnection(*connect_address)
+    try:
+        body = None if data is None else json.dumps(data)
+        headers = {} if data is None else {"Content-Type": "application/json"}
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        reply = json.loads(response.read())
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise RuntimeError(
+            f"Lookup server at {address} returned {response.status}: {reply}"
+        )
+    return reply
+
+
+def request_lookups(address, taxids):
+    """
+    Look up taxids on a running server. Returns a tuple of the list of
+    result records and the counts, in the format of LookupResults.counts.
+    """
+    reply = request(address, "POST", "/lookup", [int(x) for x in taxids])
+    counts = {
+        "queries": len(taxids),
+        "missing_taxids": len(reply["missing_taxids"]),
+        "merged_taxids": len(reply["merged_taxids"]),
+        "deleted_taxids": len(reply["deleted_taxids"]),
+    }
+    return reply["results"], counts
@@ -0,0 +1,197 @@
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+import numpy as np
+
+from atol_reference_data_lookups import logger
+from atol_reference_data_lookups.index import INDEX_VERSION, TAXID_RANGE
+from atol_reference_data_lookups.results import DELETED, MERGED, UNKNOWN
+
+# Name of the result store in the cache directory.
+RESULT_STORE_FILE = "lookup_results.sqlite"
+
+# The least recently used results are evicted once the store holds more than
+# this many.
+DEFAULT_MAX_ROWS = 1_000_000
+
+# Bump STORE_VERSION whenever the schema or the format of the stored results
+# changes, so that old stores are dropped instead of misread.
+STORE_VERSION = 1
+
+# Seconds to wait for another process that is writing to the store.
+STORE_TIMEOUT = 60
+
+
+def reference_key(checksums):
+    """
+    Return a key that identifies a set of reference file checksums and the
+    INDEX_VERSION, as results can change with the index format too.
+    """
+    reference = {"checksums": checksums, "index_version": INDEX_VERSION}
+    return hashlib.sha256(json.dumps(reference, sort_keys=True).encode()).hexdigest()
+
+
+def _storable(taxid):
+    return TAXID_RANGE.min <= taxid <= TAXID_RANGE.max
+
+
+class ResultStore:
+    """
+    SQLite store of lookup results, keyed by the checksums of the reference
+    files, the INDEX_VERSION and the taxid. Results for other reference
+    files are never returned, so the store is invalidated whenever any
+    reference file or the index format changes.
+    """
+
+    def __init__(self, file_path, checksums, max_rows=DEFAULT_MAX_ROWS):
+        self.file_path = Path(file_path)
+        self.reference = reference_key(checksums)
+        self.max_rows = max_rows
+
+        Path.mkdir(self.file_path.parent, exist_ok=True, parents=True)
+        self.connection = sqlite3.connect(self.file_path, timeout=STORE_TIMEOUT)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+            if version != STORE_VERSION:
+                if version != 0:
+                    logger.info(
+                        f"Dropping result store {self.file_path} with version "
+                        f"{version}, expected {STORE_VERSION}"
+                    )
+                self.connection.execute("DROP TABLE IF EXISTS results")
+                self.connection.execute(f"PRAGMA user_version = {STORE_VERSION}")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "reference TEXT NOT NULL, "
+                "taxid INTEGER NOT NULL, "
+                "status INTEGER NOT NULL, "
+                "result TEXT, "
+                "last_used INTEGER NOT NULL, "
+                "PRIMARY KEY (reference, taxid)"
+                ") WITHOUT ROWID"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)"
+            )
+            self._evict()
+        self.connection.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS query (taxid INTEGER PRIMARY KEY)"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def get_many(self, taxids):
+        """
+        Return a dict of taxid to a tuple of the status code and result dict
+        for the taxids that are in the store. The result is None for taxids
+        that were not found. Marks the results as used.
+        """
+        with self.connection:
+            self.connection.execute("DELETE FROM query")
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO query VALUES (?)", ((x,) for x in taxids)
+            )
+            rows = self.connection.execute(
+                "SELECT taxid, status, result FROM results "
+                "JOIN query USING (taxid) WHERE reference = ?",
+                (self.reference,),
+            ).fetchall()
+            self.connection.execute(
+                "UPDATE results SET last_used = ? WHERE reference = ? "
+                "AND taxid IN (SELECT taxid FROM query)",
+                (time.time_ns(), self.reference),
+            )
+        return {
+            taxid: (status, None if result is None else json.loads(result))
+            for taxid, status, result in rows
+        }
+
+    def put_many(self, rows):
+        """
+        Store (taxid, status code, result dict or None) rows, then evict the
+        least recently used results if the store is over max_rows.
+        """
+        now = time.time_ns()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                (
+                    (
+                        self.reference,
+                        taxid,
+                        status,
+                        None if result is None else json.dumps(result),
+                        now,
+                    )
+                    for taxid, status, result in rows
+                ),
+            )
+            self._evict()
+
+    def _evict(self):
+        n_rows = self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        excess = n_rows - self.max_rows
+        if excess <= 0:
+            return
+        logger.info(f"Evicting {excess} results from {self.file_path}")
+        self.connection.execute(
+            "DELETE FROM results WHERE (reference, taxid) IN ("
+            "SELECT reference, taxid FROM results ORDER BY last_used LIMIT ?"
+            ")",
+            (excess,),
+        )
+
+    def lookup(self, taxids, lookup_many):
+        """
+        Look up taxids, taking the results that are already in the store from
+        the store. The other taxids are de-duplicated and looked up with
+        lookup_many, which takes a list of taxids and returns a LookupResults,
+        and their results are added to the store.
+
+        Returns a tuple of the (taxid, result) records in input order, without
+        taxids that were not found, and the counts in the format of
+        LookupResults.counts.
+        """
+        unique_taxids = list(dict.fromkeys(int(x) for x in taxids))
+        # SQLite integers are 64-bit, so taxids that don't fit are never
+        # stored. They are always missing.
+        stored = self.get_many([x for x in unique_taxids if _storable(x)])
+        new_taxids = [x for x in unique_taxids if x not in stored]
+        logger.debug(
+            f"Found {len(stored)} of {len(unique_taxids)} taxids in the result store"
+        )
+
+        if new_taxids:
+            results = lookup_many(new_taxids)
+            records = dict(results.records())
+            rows = [
+                (taxid, int(status), records.get(taxid))
+                for taxid, status in zip(new_taxids, results.status)
+            ]
+            self.put_many([x for x in rows if _storable(x[0])])
+            stored.update((taxid, (status, result)) for taxid, status, result in rows)
+
+        status = np.array([stored[int(x)][0] for x in taxids], dtype=np.uint8)
+        counts = {
+            "queries": len(status),
+            "missing_taxids": int(np.count_nonzero(status == UNKNOWN)),
+            "merged_taxids": int(np.count_nonzero(status == MERGED)),
+            "deleted_taxids": int(np.count_nonzero(status == DELETED)),
+            "result_store_hits": len(stored) - len(new_taxids),
+            "result_store_misses": len(new_taxids),
+        }
+        records = [
+            (int(x), stored[int(x)][1]) for x in taxids if stored[int(x)][1] is not None
+        ]
+        return records, counts
@@ -1,15 +1,17 @@
 #!/usr/bin/env python3
 
-import skbio.tree._exception
+from functools import cached_property
 
 from atol_reference_data_lookups import logger
-from atol_reference_data_lookups.io import read_busco_mapping
+from atol_reference_data_lookups.bundle import read_bundle, read_bundle_name_index
+from atol_reference_data_lookups.index import MISSING
+from atol_reference_data_lookups.metrics import metrics
+from atol_reference_data_lookups.names import AMBIGUOUS, NOT_FOUND
 from atol_reference_data_lookups.tree import (
-    generate_augustus_tree,
+    find_lower_ranks,
     generate_taxonomy_tree,
-    get_node,
-    read_taxdump_file,
-    read_taxdump_nodes,
+    read_name_index,
+    read_taxonomy_index,
 )
 
 
@@ -22,120 +24,161 @@ class TaxdumpTree:
         taxids_to_busco_dataset_mapping,
         taxids_to_augustus_dataset_mapping,
         cache_dir,
+        verify_cache=False,
+        merged_file=None,
+        delnodes_file=None,
+        index_bundle=None,
     ):
-        logger.info(f"Reading NCBI taxonomy from {nodes_file}")
-        self.nodes, nodes_changed = read_taxdump_file(
-            nodes_file, cache_dir, "nodes_slim"
-        )
-
-        logger.info(f"Reading full NCBI nodes from {nodes_file}")
-        self.nodes_full, nodes_full_changed = read_taxdump_nodes(
-            nodes_file, cache_dir
-        )
-
-        logger.info(f"Reading NCBI taxon names from {names_file}")
-        names, names_changed = read_taxdump_file(names_file, cache_dir, "names")
-
-        update_tree = any([nodes_changed, names_changed])
-
-        self.tree = generate_taxonomy_tree(
-            names, self.nodes, cache_dir, update_tree=update_tree
-        )
-
+        self.cache_dir = cache_dir
+        self.names_file = names_file
+        self.index_bundle = index_bundle
+
+        # A bundle written by bundle.write_bundle replaces the reference files.
+        with metrics.phase("load_taxonomy"):
+            if index_bundle is not None:
+                self.index = read_bundle(index_bundle, verify=verify_cache)
+            else:
+                self.index = read_taxonomy_index(
+                    nodes_file,
+                    names_file,
+                    taxids_to_busco_dataset_mapping,
+                    taxids_to_augustus_dataset_mapping,
+                    cache_dir,
+                    verify=verify_cache,
+                    merged_file=merged_file,
+                    delnodes_file=delnodes_file,
+                )
+        logger.info(f"    ... indexed {len(self.index)} taxids")
         logger.info(
-            f"Reading BUSCO dataset mapping from {taxids_to_busco_dataset_mapping}"
+            f"    ... found {len(self.index.busco_datasets)} datasets in BUSCO tree"
         )
-        self.busco_mapping = read_busco_mapping(taxids_to_busco_dataset_mapping)
         logger.info(
-            f"    ... found {len(self.busco_mapping)} datasets in BUSCO mapping file"
+            f"    ... found {len(self.index.augustus_datasets)} datasets in Augustus tree"
         )
 
-        self.augustus_mapping, self.augustus_tree, self.augustus_tip_names = (
-            generate_augustus_tree(
-                self.tree, taxids_to_augustus_dataset_mapping, cache_dir, update_tree
+    @cached_property
+    def tree(self):
+        """
+        The full skbio taxonomy tree. Lookups are answered from self.index, so
+        the tree is only loaded from the cache if something asks for it.
+        """
+        return generate_taxonomy_tree(
+            self.index, self.cache_dir, self.index.checksums["nodes"]
+        )
+
+    @cached_property
+    def name_index(self):
+        """
+        The NameIndex of names.dmp. It is only built, or loaded from the
+        cache, if something looks up a name.
+        """
+        if self.index_bundle is not None:
+            return read_bundle_name_index(
+                self.index_bundle, self.index.checksums["names"]
             )
+        return read_name_index(
+            self.names_file, self.cache_dir, self.index.checksums["names"]
         )
 
+    def resolve_name(self, name, case_sensitive=False):
+        """
+        Return the taxid of a scientific name, synonym or other name, or None
+        if no taxid or more than one taxid has that name.
+        """
+        taxid = int(self.name_index.resolve_many([name], case_sensitive)[0])
+        return None if taxid in (NOT_FOUND, AMBIGUOUS) else taxid
+
+    def resolve_names(self, names, case_sensitive=False):
+        """
+        Resolve many names to taxids at once. Returns a numpy array of taxids
+        in input order, with names.NOT_FOUND for names that aren't in
+        names.dmp and names.AMBIGUOUS for names of more than one taxid.
+        """
+        return self.name_index.resolve_many(names, case_sensitive)
+
+    def search_names(self, prefix, limit=None):
+        """
+        Return (name, taxid, name_class) for names that start with prefix,
+        ignoring case, in sorted order.
+        """
+        return self.name_index.search_prefix(prefix, limit)
+
     def get_node(self, taxid):
-        """Look up a node in the taxonomy tree by taxid."""
-        return get_node(self.tree, taxid)
+        """
+        Look up a taxid in the taxonomy index. Returns the taxid as an int, or
+        None if it is not in the taxonomy.
+        """
+        if taxid in self.index:
+            return int(taxid)
+        logger.debug(f"Node for taxid {taxid} not found in index.")
+        return None
+
+    def resolve_taxid(self, taxid):
+        """
+        Resolve a taxid that NCBI has merged into another taxid. Returns a
+        tuple of the resolved taxid and its status, which is one of "current",
+        "merged", "deleted" or "unknown".
+        """
+        return self.index.resolve(taxid)
 
     def get_ancestor_taxids(self, taxid):
         logger.debug(f"Looking up ancestors for taxid {taxid}")
-        node = self.get_node(taxid)
-        if node is None:
+        if taxid not in self.index:
             logger.warning(f"Cannot find ancestors for taxid {taxid}: not in tree")
             return []
-        ancestor_taxids = [x.name for x in node.ancestors()]
+        ancestor_taxids = self.index.ancestors(taxid)
         logger.debug(f"ancestor_taxids: {ancestor_taxids}")
         return ancestor_taxids
 
-    def get_busco_lineage(self, taxid, ancestor_taxids):
+    def get_descendant_taxids(self, taxid, include_self=False):
         """
-        Find the closest ancestor that is in the BUSCO taxid map and return the
-        lineage name.
+        Return the taxids of every node under taxid, in pre-order, as a numpy
+        array. Unknown taxids have no descendants.
         """
-        logger.debug(f"Looking up BUSCO dataset name for taxid {taxid}")
-        logger.debug(f"Checking ancestor_taxids {ancestor_taxids}")
-
-        for ancestor_taxid in ancestor_taxids:
-            if int(ancestor_taxid) in self.busco_mapping:
-                return self.busco_mapping[int(ancestor_taxid)]
-            if ancestor_taxid in self.busco_mapping:
-                return self.busco_mapping[ancestor_taxid]
-
-        return None
+        logger.debug(f"Looking up descendants for taxid {taxid}")
+        if taxid not in self.index:
+            logger.warning(f"Cannot find descendants for taxid {taxid}: not in tree")
+        return self.index.descendants(taxid, include_self)
 
-    def get_augustus_lineage(self, taxid, ancestor_taxids):
-        logger.debug(f"Looking up Augustus dataset name for taxid {taxid}")
-
-        # Include taxid in the search, in case it has been trained
-        search_taxids = [taxid] + list(ancestor_taxids)
-
-        closest_taxid_in_augustus_tree = None
-        while not closest_taxid_in_augustus_tree and len(search_taxids) > 0:
-            current = search_taxids.pop(0)
-            logger.debug(f"Checking Augustus tree for {current}")
-            closest_taxid_in_augustus_tree = get_node(
-                self.augustus_tree, current
-            )
-
-        if not closest_taxid_in_augustus_tree:
-            return None
-
-        logger.debug(
-            f"Found closest_taxid_in_augustus_tree {closest_taxid_in_augustus_tree.name}"
-        )
-
-        dist_to_dataset = {}
-        for augustus_taxid in self.augustus_mapping:
-            logger.debug(f"Calculating distance to {augustus_taxid}")
-            dest_node = get_node(self.augustus_tree, augustus_taxid)
-            if dest_node is None:
-                logger.debug(f"{augustus_taxid} not in Augustus tree")
-                continue
-            try:
-                dist_to_dataset[augustus_taxid] = (
-                    closest_taxid_in_augustus_tree.distance(
-                        dest_node, use_length=False
-                    )
-                )
-                logger.debug(f"    ...{dist_to_dataset[augustus_taxid]}")
-            except skbio.tree._exception.MissingNodeError:
-                logger.debug(f"{augustus_taxid} not in Augustus tree")
+    def is_in_clade(self, taxid, clade):
+        """Return True if taxid is clade or one of its descendants."""
+        return bool(self.index.in_clade([taxid], clade)[0])
 
-        logger.debug(f"Distances: {dist_to_dataset}")
+    def in_clade_many(self, taxids, clade):
+        """
+        Return a boolean numpy array of whether each of taxids is clade or one
+        of its descendants.
+        """
+        return self.index.in_clade(taxids, clade)
 
-        if not dist_to_dataset:
-            return None
+    def get_rank_counts(self, clade):
+        """Return a dict of the number of nodes of each rank in clade."""
+        return self.index.rank_counts(clade)
 
-        closest_dataset = min(dist_to_dataset, key=dist_to_dataset.get)
+    def find_lower_ranks(self, top_rank="species", excluded_ranks=None, clade=None):
+        """
+        Return the sorted ranks found at or below any node of rank top_rank,
+        optionally only in clade.
+        """
+        return find_lower_ranks(self.index, top_rank, excluded_ranks, clade)
 
-        logger.debug(
-            f"Closest dataset is {closest_dataset} with dist {dist_to_dataset[closest_dataset]}"
-        )
+    def get_busco_lineage(self, taxid, ancestor_taxids=None):
+        """
+        Find the closest ancestor that is in the BUSCO taxid map and return the
+        lineage name. The lineage of every taxid is precomputed when the index
+        is built, so ancestor_taxids is not needed and is ignored.
+        """
+        logger.debug(f"Looking up BUSCO dataset name for taxid {taxid}")
+        return self.index.busco_dataset(taxid)
 
-        return self.augustus_mapping[closest_dataset]
+    def get_augustus_lineage(self, taxid, ancestor_taxids=None):
+        """
+        Return the Augustus dataset closest to taxid in the pruned Augustus
+        tree. The closest dataset for every taxid is precomputed when the
+        index is built, so ancestor_taxids is not needed and is ignored.
+        """
+        logger.debug(f"Looking up Augustus dataset name for taxid {taxid}")
+        return self.index.augustus_dataset(taxid)
 
     def get_genetic_codes(self, taxid):
         """
@@ -145,13 +188,41 @@ class TaxdumpTree:
         Returns a tuple of (genetic_code_id, mitochondrial_genetic_code_id).
         """
         logger.debug(f"Looking up genetic codes for taxid {taxid}")
-        node = self.get_node(taxid)
-        if node is None:
+        if taxid not in self.index:
             logger.warning(f"Cannot find genetic codes for taxid {taxid}: not in tree")
             return (None, None)
-        try:
-            row = self.nodes_full.loc[int(taxid)]
-        except KeyError:
-            logger.warning(f"Taxid {taxid} not found in nodes_full DataFrame")
-            return (None, None)
-        return (row["genetic_code_id"], row["mitochondrial_genetic_code_id"])
+        return self.index.genetic_codes(taxid)
+
+    def lookup_many(self, taxids):
+        """
+        Look up the BUSCO and Augustus datasets and genetic codes for many
+        taxids at once. taxids can be a numpy array or any iterable of ints.
+        Merged taxids are resolved to the taxid they were merged into.
+
+        Returns a LookupResults with one row per query, in input order.
+        """
+        return self.index.lookup_many(taxids)
+
+    def lca(self, taxid_a, taxid_b):
+        """
+        Return the lowest common ancestor of two taxids, or None if either is
+        not in the taxonomy.
+        """
+        lca = int(self.index.lca_pairs([taxid_a], [taxid_b])[0])
+        return None if lca == MISSING else lca
+
+    def lca_many(self, taxids):
+        """
+        Return the lowest common ancestor of all of taxids, or None if any of
+        them is not in the taxonomy.
+        """
+        lca = self.index.common_ancestor(taxids)
+        return None if lca == MISSING else lca
+
+    def distance(self, taxid_a, taxid_b):
+        """
+        Return the number of edges between two taxids in the taxonomy, or None
+        if either is not in the taxonomy.
+        """
+        distance = int(self.index.distance_pairs([taxid_a], [taxid_b])[0])
+        return None if distance == MISSING else distance
@@ -1,212 +1,468 @@
-import shelve
-from pathlib import Path
+# pandas and skbio are slow to import and are only needed for the full
+# taxonomy tree, so they are imported where they are used rather than here.
 
-import pandas as pd
-import skbio.io
-import skbio.tree._exception
-import skbio.tree._tree
-from skbio.tree import TreeNode
+import pickle
+from pathlib import Path
 
 from atol_reference_data_lookups import logger
-from atol_reference_data_lookups.cache import compute_sha256, open_cache
-from atol_reference_data_lookups.io import read_augustus_mapping
+from atol_reference_data_lookups.cache import atomic_write, cache_lock, get_checksums
+from atol_reference_data_lookups.index import TaxonomyIndex
+from atol_reference_data_lookups.io import (
+    read_augustus_mapping,
+    read_busco_mapping,
+    read_taxdump_delnodes,
+    read_taxdump_merged,
+    read_taxdump_names,
+    read_taxdump_nodes,
+)
+from atol_reference_data_lookups.metrics import metrics
+from atol_reference_data_lookups.names import NameIndex
+
+# Names of the cached TaxonomyIndex, NameIndex and skbio tree in the cache
+# directory.
+INDEX_CACHE_FILE = "taxonomy_index.bin"
+NAME_INDEX_CACHE_FILE = "name_index.bin"
+TREE_CACHE_FILE = "taxonomy_tree.pickle"
+
+# Reference files that only change the datasets, not the taxonomy. If only
+# these have changed, the cached taxonomy is reused, and if they haven't, the
+# datasets of the cached index are reused for the taxids that haven't moved.
+# Extra BUSCO placement files have keys busco.1, busco.2 and so on.
+DATASET_MAPPING_FILES = ("busco", "augustus")
+
+
+def get_reference_files(
+    nodes_file,
+    names_file,
+    taxids_to_busco_dataset_mapping,
+    taxids_to_augustus_dataset_mapping,
+    merged_file=None,
+    delnodes_file=None,
+):
+    """
+    Return a dict of the reference files, keyed as they are in the checksums
+    of the TaxonomyIndex. taxids_to_busco_dataset_mapping is a path or a list
+    of paths.
+    """
+    reference_files = {"nodes": nodes_file, "names": names_file}
+    for i, file_path in enumerate(_as_list(taxids_to_busco_dataset_mapping)):
+        reference_files["busco" if i == 0 else f"busco.{i}"] = file_path
+    reference_files["augustus"] = taxids_to_augustus_dataset_mapping
+    if merged_file is not None:
+        reference_files["merged"] = merged_file
+    if delnodes_file is not None:
+        reference_files["delnodes"] = delnodes_file
+    return reference_files
+
+
+def _as_list(file_paths):
+    if isinstance(file_paths, (list, tuple)):
+        return list(file_paths)
+    return [file_paths]
+
+
+def read_taxonomy_index(
+    nodes_file,
+    names_file,
+    taxids_to_busco_dataset_mapping,
+    taxids_to_augustus_dataset_mapping,
+    cache_dir,
+    verify=False,
+    merged_file=None,
+    delnodes_file=None,
+):
+    """
+    Open the cached TaxonomyIndex. The cache is rebuilt if it is missing, was
+    written by an incompatible version, or if any of the reference files have
+    changed.
 
+    taxids_to_busco_dataset_mapping is one BUSCO placement file, or a list of
+    them that are merged into one mapping.
 
-def read_taxdump_file(file_path, cache_dir, scheme):
-    """
-    Reads the taxdump file and caches it in a shelve file.
+    merged_file and delnodes_file are the optional merged.dmp and delnodes.dmp
+    from taxdump, used to resolve merged and deleted taxids.
 
-    Return a tuple of the data and a boolean indicating whether the cache was
-    updated.
+    Reference files are only hashed if their size, mtime or inode has changed
+    since they were last hashed, unless verify is True.
     """
-    cache_file = Path(cache_dir, f"{Path(file_path).stem}_{scheme}.db")
+    cache_file = Path(cache_dir, INDEX_CACHE_FILE)
     Path.mkdir(cache_file.parent, exist_ok=True, parents=True)
-    current_checksum = compute_sha256(file_path)
-
-    with shelve.open(cache_file) as cache:
-        if (
-            "data" in cache
-            and "checksum" in cache
-            and cache["checksum"] == current_checksum
-        ):
-            logger.info(f"Reading {scheme} from cache {cache_file}")
-            return (cache["data"], False)
-        else:
-            data = skbio.io.read(file_path, "taxdump", into=pd.DataFrame, scheme=scheme)
-            logger.info(f"Writing {scheme} to cache {cache_file}")
-            cache["data"] = data
-            cache["checksum"] = current_checksum
-            return (data, True)
-
-
-def read_taxdump_nodes(file_path, cache_dir):
-    """
-    Read the full nodes.dmp file into a DataFrame indexed by tax_id,
-    with caching.
-    """
-    cache_file = Path(cache_dir, "nodes_full_df.db")
-    nodes_full_df_checksum = compute_sha256(file_path)
-
-    with shelve.open(cache_file) as cache:
-        if (
-            "nodes_full_df" in cache
-            and "nodes_full_df_checksum" in cache
-            and cache["nodes_full_df_checksum"] == nodes_full_df_checksum
-        ):
-            logger.info(f"Reading full nodes from cache {cache_file}")
-            return (cache["nodes_full_df"], False)
-        else:
-            data = skbio.io.read(
-                file_path, "taxdump", into=pd.DataFrame, scheme="nodes"
+    reference_files = get_reference_files(
+        nodes_file,
+        names_file,
+        taxids_to_busco_dataset_mapping,
+        taxids_to_augustus_dataset_mapping,
+        merged_file,
+        delnodes_file,
+    )
+    with metrics.phase("checksums"):
+        checksums = get_checksums(reference_files, cache_dir, verify=verify)
+
+    index = _load_cached_index(cache_file)
+    if index is not None and index.checksums == checksums:
+        logger.info(f"Reading taxonomy index from cache {cache_file}")
+        metrics.cache("taxonomy_index", hit=True)
+        return index
+
+    # Only one process builds the index. Any others wait here, then read the
+    # index it built.
+    with cache_lock(cache_file):
+        previous = _load_cached_index(cache_file)
+        if previous is not None and previous.checksums == checksums:
+            logger.info(f"Reading taxonomy index from cache {cache_file}")
+            metrics.cache("taxonomy_index", hit=True)
+            return previous
+        metrics.cache("taxonomy_index", hit=False)
+
+        index = _update_cached_index(
+            previous,
+            cache_file,
+            checksums,
+            nodes_file,
+            taxids_to_busco_dataset_mapping,
+            taxids_to_augustus_dataset_mapping,
+            merged_file,
+            delnodes_file,
+        )
+        index.checksums = checksums
+        logger.info(f"Writing taxonomy index to cache {cache_file}")
+        with metrics.phase("write_index"):
+            index.save(cache_file)
+        return index
+
+
+def _update_cached_index(
+    previous,
+    cache_file,
+    checksums,
+    nodes_file,
+    taxids_to_busco_dataset_mapping,
+    taxids_to_augustus_dataset_mapping,
+    merged_file,
+    delnodes_file,
+):
+    """
+    Return the index for the current reference files, reusing as much of
+    previous, the index in the cache, as they allow. If nodes.dmp is from a
+    newer release, previous is updated with the differences between the two
+    releases instead of being built from scratch.
+    """
+    if previous is None:
+        index = _parse_taxonomy(nodes_file, merged_file, delnodes_file)
+        _set_datasets(
+            index, taxids_to_busco_dataset_mapping, taxids_to_augustus_dataset_mapping
+        )
+        return index
+
+    changed_files = _changed_files(previous.checksums, checksums)
+    logger.info(
+        f"{', '.join(sorted(changed_files))} changed since {cache_file} was written"
+    )
+    datasets_changed = not changed_files.isdisjoint(DATASET_MAPPING_FILES)
+
+    if "nodes" not in changed_files:
+        logger.info(f"Reusing the taxonomy in {cache_file}")
+        index = previous
+        if not changed_files.isdisjoint(("merged", "delnodes")):
+            _set_merged_and_deleted(index, merged_file, delnodes_file)
+        if datasets_changed:
+            _set_datasets(
+                index,
+                taxids_to_busco_dataset_mapping,
+                taxids_to_augustus_dataset_mapping,
             )
-            logger.info(f"Writing full nodes to cache {cache_file}")
-            cache["nodes_full_df"] = data
-            cache["nodes_full_df_checksum"] = nodes_full_df_checksum
-            return (data, True)
-
-
-def generate_taxonomy_tree(names, nodes, cache_dir, update_tree=False):
-    cache_file = Path(cache_dir, "taxonomy_tree.db")
-    with shelve.open(cache_file) as cache:
-        if "tree" in cache and not update_tree:
-            logger.info(f"Reading taxonomy tree from {cache_file}")
-            return cache["tree"]
-        else:
-            logger.info("Generating taxonomy tree")
-            tree = TreeNode.from_taxdump(nodes)
-            logger.info("Indexing tree")
-            tree.index_tree()
-            cache["tree"] = tree
-            return tree
+        return index
+
+    logger.info(f"Updating the taxonomy in {cache_file} from {nodes_file}")
+    with metrics.phase("parse_nodes"):
+        index = TaxonomyIndex.from_records(read_taxdump_nodes(nodes_file))
+    with metrics.phase("diff_taxonomy"):
+        changed = index.changed_taxids(previous)
+    logger.info(f"    ... {len(changed)} taxids have moved or are new")
+    with metrics.phase("preorder"):
+        index.set_preorder_from(previous, changed)
+    _set_merged_and_deleted(index, merged_file, delnodes_file)
+
+    if datasets_changed:
+        _set_datasets(
+            index, taxids_to_busco_dataset_mapping, taxids_to_augustus_dataset_mapping
+        )
+    else:
+        _update_datasets(
+            index,
+            previous,
+            changed,
+            taxids_to_busco_dataset_mapping,
+            taxids_to_augustus_dataset_mapping,
+        )
+    return index
+
+
+def _load_cached_index(cache_file):
+    """Return the cached index, or None if there is no usable cache."""
+    if not cache_file.exists():
+        return None
+    try:
+        with metrics.phase("read_index"):
+            return TaxonomyIndex.load(cache_file)
+    except ValueError as e:
+        logger.info(f"Ignoring cache {cache_file}: {e}")
+        return None
+
+
+def _changed_files(cached_checksums, checksums):
+    """
+    Return the keys of the reference files whose checksums differ, or that
+    are only in one of them. Extra BUSCO placement files count as busco.
+    """
+    return {
+        k.partition(".")[0]
+        for k in set(cached_checksums) | set(checksums)
+        if cached_checksums.get(k) != checksums.get(k)
+    }
+
+
+def _parse_taxonomy(nodes_file, merged_file, delnodes_file):
+    logger.info(f"Parsing NCBI taxonomy from {nodes_file}")
+    with metrics.phase("parse_nodes"):
+        index = TaxonomyIndex.from_records(read_taxdump_nodes(nodes_file))
+    logger.info("Indexing the taxonomy for common ancestor queries")
+    with metrics.phase("preorder"):
+        index.set_preorder()
+    _set_merged_and_deleted(index, merged_file, delnodes_file)
+    return index
+
+
+def _set_merged_and_deleted(index, merged_file, delnodes_file):
+    if merged_file is None and delnodes_file is None:
+        index.set_merged_and_deleted([], [])
+        return
+    logger.info("Indexing merged and deleted taxids")
+    merged = [] if merged_file is None else read_taxdump_merged(merged_file)
+    deleted = [] if delnodes_file is None else read_taxdump_delnodes(delnodes_file)
+    with metrics.phase("parse_merged_and_deleted"):
+        index.set_merged_and_deleted(merged, deleted)
+    logger.info(
+        f"    ... found {len(index.merged_from)} merged and "
+        f"{len(index.deleted)} deleted taxids"
+    )
 
 
-def get_node(tree, taxid):
-    for search_id in (int(taxid), str(taxid)):
-        try:
-            node = tree.find(search_id)
-            if isinstance(node, skbio.tree._tree.TreeNode):
-                return node
-        except (skbio.tree._exception.MissingNodeError, ValueError):
-            continue
+def _set_datasets(
+    index, taxids_to_busco_dataset_mapping, taxids_to_augustus_dataset_mapping
+):
+    busco_mapping = _read_busco_mapping(taxids_to_busco_dataset_mapping)
+    logger.info("Finding the BUSCO dataset for each node")
+    with metrics.phase("busco_datasets"):
+        index.set_busco_datasets(busco_mapping)
 
-    logger.debug(f"Node for taxid {taxid} not found in tree.")
-    return None
+    augustus_taxids, augustus_mapping = _augustus_tree(
+        index, taxids_to_augustus_dataset_mapping
+    )
+    logger.info("Finding the closest Augustus dataset for each node")
+    with metrics.phase("augustus_datasets"):
+        index.set_augustus_datasets(augustus_taxids, augustus_mapping)
 
 
-def find_lower_ranks(tree, top_rank="species", excluded_ranks=None):
-    if excluded_ranks is None:
-        excluded_ranks = ["no rank"]
-    rank_list = _recursive_find_lower_ranks(tree, top_rank)
-    return [rank for rank in sorted(set(rank_list)) if rank not in excluded_ranks]
+def _update_datasets(
+    index,
+    previous,
+    changed,
+    taxids_to_busco_dataset_mapping,
+    taxids_to_augustus_dataset_mapping,
+):
+    """
+    Copy the datasets from previous, which was built with the same dataset
+    mapping files, and only find them again for the changed taxids.
+    """
+    busco_mapping = _read_busco_mapping(taxids_to_busco_dataset_mapping)
+    logger.info("Updating the BUSCO datasets of the changed taxids")
+    with metrics.phase("busco_datasets"):
+        index.update_busco_datasets(previous, changed, busco_mapping)
 
+    augustus_taxids, augustus_mapping = _augustus_tree(
+        index, taxids_to_augustus_dataset_mapping
+    )
+    logger.info("Updating the Augustus datasets of the changed taxids")
+    with metrics.phase("augustus_datasets"):
+        index.update_augustus_datasets(
+            previous, changed, augustus_taxids, augustus_mapping
+        )
 
-def _recursive_find_lower_ranks(
-    tree, top_rank="species", rank_list=None, top_rank_or_lower=False
-):
-    if rank_list is None:
-        rank_list = []
-    if tree.rank == top_rank:
-        top_rank_or_lower = True
-    if top_rank_or_lower:
-        for node in tree.traverse():
-            rank_list.append(node.rank)
-    else:
-        for node in tree.children:
-            _recursive_find_lower_ranks(node, top_rank, rank_list, top_rank_or_lower)
-    return rank_list
 
+def _read_busco_mapping(taxids_to_busco_dataset_mapping):
+    busco_files = ", ".join(str(x) for x in _as_list(taxids_to_busco_dataset_mapping))
+    logger.info(f"Reading BUSCO dataset mapping from {busco_files}")
+    with metrics.phase("read_busco_mapping"):
+        busco_mapping = read_busco_mapping(taxids_to_busco_dataset_mapping)
+    logger.info(f"    ... found {len(busco_mapping)} datasets in BUSCO mapping file")
+    return busco_mapping
 
-def generate_augustus_tree(
-    tree, taxids_to_augustus_dataset_mapping, cache_dir, update_tree=False
-):
-    cache_file = Path(cache_dir, "augustus_tree.db")
-    taxids_to_augustus_dataset_mapping_checksum = compute_sha256(
-        taxids_to_augustus_dataset_mapping
-    )
 
+def _augustus_tree(index, taxids_to_augustus_dataset_mapping):
+    """
+    Return the taxids of the pruned Augustus tree and the Augustus dataset
+    mapping.
+    """
     logger.info(
         f"Reading Augustus dataset mapping from {taxids_to_augustus_dataset_mapping}"
     )
     augustus_mapping = read_augustus_mapping(taxids_to_augustus_dataset_mapping)
-    logger.info(
-        f"    ... found {len(augustus_mapping.keys())} datasets in Augustus mapping file"
+    missing_taxids = [x for x in augustus_mapping if x not in index]
+    if missing_taxids:
+        logger.warning(
+            f"Skipping {len(missing_taxids)} taxids not found in tree: "
+            f"{missing_taxids}"
+        )
+    logger.info("Pruning tree for Augustus datasets")
+    with metrics.phase("prune_augustus_tree"):
+        augustus_taxids = index.augustus_tree_taxids(
+            [x for x in augustus_mapping if x in index]
+        )
+    logger.debug(f"    ... Augustus tree has {len(augustus_taxids)} nodes.")
+    return augustus_taxids, augustus_mapping
+
+
+def read_name_index(names_file, cache_dir, checksum):
+    """
+    Open the cached NameIndex, or build it from names_file if the cache is
+    missing or was built from a different file. checksum identifies
+    names_file.
+    """
+    cache_file = Path(cache_dir, NAME_INDEX_CACHE_FILE)
+    index = _load_cached_name_index(cache_file, checksum)
+    if index is not None:
+        return index
+
+    with cache_lock(cache_file):
+        index = _load_cached_name_index(cache_file, checksum)
+        if index is not None:
+            return index
+        metrics.cache("name_index", hit=False)
+        logger.info(f"Indexing names from {names_file}")
+        with metrics.phase("parse_names"):
+            index = NameIndex.from_records(read_taxdump_names(names_file))
+        logger.info(f"    ... indexed {len(index)} names")
+        index.checksum = checksum
+        logger.info(f"Writing name index to cache {cache_file}")
+        with metrics.phase("write_name_index"):
+            index.save(cache_file)
+        return index
+
+
+def _load_cached_name_index(cache_file, checksum):
+    """Return the cached name index if it was built from checksum, otherwise None."""
+    if not cache_file.exists():
+        return None
+    try:
+        with metrics.phase("read_name_index"):
+            index = NameIndex.load(cache_file)
+    except ValueError as e:
+        logger.info(f"Ignoring cache {cache_file}: {e}")
+        return None
+    if index.checksum != checksum:
+        return None
+    logger.info(f"Reading name index from cache {cache_file}")
+    metrics.cache("name_index", hit=True)
+    return index
+
+
+def nodes_from_index(index, taxids=None):
+    """
+    Return the nodes_slim DataFrame that TreeNode.from_taxdump expects, built
+    from a TaxonomyIndex. Defaults to all taxids in the index.
+    """
+    import pandas as pd
+
+    if taxids is None:
+        taxids = index.taxids
+    return pd.DataFrame(
+        {
+            "parent_tax_id": index.parent[taxids],
+            "rank": pd.Categorical.from_codes(
+                index.rank_code[taxids], categories=index.rank_names
+            ).astype(str),
+        },
+        index=pd.Index(taxids, name="tax_id"),
     )
 
-    with shelve.open(cache_file) as cache:
-        if (
-            "augustus_tree" in cache
-            and "augustus_tip_names" in cache
-            and "taxids_to_augustus_dataset_mapping_checksum" in cache
-            and cache["taxids_to_augustus_dataset_mapping_checksum"]
-            == taxids_to_augustus_dataset_mapping_checksum
-            and not update_tree
-        ):
-            logger.info(f"Reading Augustus tree from {cache_file}")
-            return augustus_mapping, cache["augustus_tree"], cache["augustus_tip_names"]
-
-        else:
-            logger.info("Pruning tree for Augustus datasets")
-            augustus_tree = tree.copy(deep=True)
-            initial_node_count = int(augustus_tree.count())
-
-            augustus_nodes = [
-                get_node(augustus_tree, x) for x in augustus_mapping.keys()
-            ]
-
-            missing_taxids = [
-                taxid
-                for taxid, node in zip(augustus_mapping.keys(), augustus_nodes)
-                if node is None
-            ]
-            if missing_taxids:
-                logger.warning(
-                    f"Skipping {len(missing_taxids)} taxids not found in tree: "
-                    f"{missing_taxids}"
+
+def generate_taxonomy_tree(index, cache_dir, checksum):
+    """
+    Build the full skbio taxonomy tree from a TaxonomyIndex, with caching.
+    checksum identifies the nodes.dmp the index was built from.
+    """
+    with metrics.phase("import_skbio"):
+        from skbio.tree import TreeNode
+
+    cache_file = Path(cache_dir, TREE_CACHE_FILE)
+    tree = _read_cached_tree(cache_file, checksum)
+    if tree is not None:
+        return tree
+
+    with cache_lock(cache_file):
+        tree = _read_cached_tree(cache_file, checksum)
+        if tree is not None:
+            return tree
+        logger.info("Generating taxonomy tree")
+        metrics.cache("taxonomy_tree", hit=False)
+        with metrics.phase("build_taxonomy_tree"):
+            tree = TreeNode.from_taxdump(nodes_from_index(index))
+        logger.info("Indexing tree")
+        with metrics.phase("index_taxonomy_tree"):
+            tree.index_tree()
+        with metrics.phase("write_taxonomy_tree"):
+            with atomic_write(cache_file) as tmp_file, open(tmp_file, "wb") as f:
+                pickle.dump(
+                    {"checksum": checksum, "tree": tree},
+                    f,
+                    protocol=pickle.HIGHEST_PROTOCOL,
                 )
+        return tree
 
-            augustus_nodes = [node for node in augustus_nodes if node is not None]
-            augustus_node_names = [x.name for x in augustus_nodes]
-            logger.debug(
-                f"Found {len(augustus_node_names)} Augustus taxids in tree:\n{augustus_node_names}"
-            )
 
-            for node in augustus_nodes:
-                if node.has_children():
-                    node_children = node.children
-                    logger.debug(
-                        f"Node {node.name} has children {[x.name for x in node_children]}"
-                    )
-                    for child in node_children:
-                        logger.debug(f"Removing node {child.name}")
-                        removed = node.remove(child)
-                        logger.debug(f"Removed? {removed}")
-
-                    if not node.is_tip():
-                        node.pop()
-
-                logger.debug(f"Is node {node.name} a tip? {node.is_tip()}")
-
-            sheared_augustus_tree = augustus_tree.shear(
-                names=augustus_node_names,
-                prune=False,
-                inplace=False,
-                strict=False,
-            )
+def _read_cached_tree(cache_file, checksum):
+    """Return the cached tree if it was built from checksum, otherwise None."""
+    if not cache_file.exists():
+        return None
+    with metrics.phase("read_taxonomy_tree"):
+        try:
+            with open(cache_file, "rb") as f:
+                cache = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            logger.info(f"Ignoring cache {cache_file}: {e}")
+            return None
+    if cache.get("checksum") != checksum:
+        return None
+    logger.info(f"Reading taxonomy tree from {cache_file}")
+    metrics.cache("taxonomy_tree", hit=True)
+    return cache["tree"]
 
-            final_node_count = int(sheared_augustus_tree.count())
-            nodes_removed = initial_node_count - final_node_count
 
-            logger.debug(f"    ... NCBI tree had {initial_node_count} nodes.")
-            logger.debug(f"    ... Removed {nodes_removed} nodes.")
-            logger.debug(f"    ... Augustus tree has {final_node_count} nodes.")
+def get_node(tree, taxid):
+    import skbio.tree._exception
+    import skbio.tree._tree
 
-            augustus_tip_names = [x.name for x in sheared_augustus_tree.tips()]
+    for search_id in (int(taxid), str(taxid)):
+        try:
+            node = tree.find(search_id)
+            if isinstance(node, skbio.tree._tree.TreeNode):
+                return node
+        except (skbio.tree._exception.MissingNodeError, ValueError):
+            continue
+
+    logger.debug(f"Node for taxid {taxid} not found in tree.")
+    return None
 
-            logger.info("Caching the pruned Augustus tree")
-            cache["augustus_tree"] = sheared_augustus_tree
-            cache["augustus_tip_names"] = augustus_tip_names
-            cache["taxids_to_augustus_dataset_mapping_checksum"] = (
-                taxids_to_augustus_dataset_mapping_checksum
-            )
 
-            return augustus_mapping, sheared_augustus_tree, augustus_tip_names
+def find_lower_ranks(index, top_rank="species", excluded_ranks=None, clade=None):
+    """
+    Return the sorted ranks of the nodes of rank top_rank and all of their
+    descendants in a TaxonomyIndex, except excluded_ranks. With clade, only
+    nodes in that clade are used. The pre-order intervals in the index give
+    the descendants of each node directly, so there is no recursion.
+    """
+    if excluded_ranks is None:
+        excluded_ranks = ["no rank"]
+    rank_list = index.lower_ranks(top_rank, clade)
+    return [rank for rank in sorted(rank_list) if rank not in excluded_ranks]
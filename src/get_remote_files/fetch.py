@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+# urllib.request and tarfile are only needed to fetch files, so they are
+# imported where they are used and get-remote-files still starts quickly.
+
+from pathlib import Path
+import argparse
+import hashlib
+import logging
+import os
+import shutil
+import sys
+
+logger = logging.getLogger(__name__)
+
+TAXDUMP_URL = "ftp://ftp.ncbi.nih.gov/pub/taxonomy/new_taxdump/new_taxdump.tar.gz"
+TAXDUMP_ARCHIVE = "new_taxdump.tar.gz"
+
+# Members of new_taxdump.tar.gz that atol-reference-data-lookups reads. The
+# others include multi-GB files like fullnamelineage.dmp and typematerial.dmp.
+TAXDUMP_MEMBERS = (
+    "nodes.dmp",
+    "names.dmp",
+    "merged.dmp",
+    "delnodes.dmp",
+    "gencode.dmp",
+)
+
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+def resolve_source(source):
+    """
+    Return the URL of an archive. source is a URL (http, https, ftp or file),
+    a path to the archive, or a path to a directory that mirrors it, i.e. that
+    has a file with the same name as the archive on the NCBI server.
+    """
+    if source.split(":", 1)[0] in ("http", "https", "ftp", "file"):
+        return source
+    path = Path(source)
+    if path.is_dir():
+        path = Path(path, TAXDUMP_ARCHIVE)
+    return path.resolve().as_uri()
+
+
+def read_md5(url):
+    """Return the MD5 checksum from url + ".md5", which is in md5sum format."""
+    from urllib.request import urlopen
+
+    with urlopen(f"{url}.md5") as f:
+        fields = f.read().decode().split()
+    if not fields:
+        raise ValueError(f"{url}.md5 is empty")
+    return fields[0].lower()
+
+
+class _HashingReader:
+    """Wraps a binary file and hashes everything that is read from it."""
+
+    def __init__(self, f):
+        self.f = f
+        self.md5 = hashlib.md5()
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.md5.update(data)
+        self.bytes_read += len(data)
+        return data
+
+    def drain(self):
+        """Read and hash the rest of the file."""
+        while self.read(READ_BLOCK_SIZE):
+            pass
+
+
+def fetch_archive(source, out_dir, members=TAXDUMP_MEMBERS, verify_md5=True):
+    """
+    Download the tar.gz archive at source and extract members to out_dir in
+    one pass. The archive is never written to disk, and the MD5 checksum is
+    computed while it streams. Members that aren't in members are
+    decompressed but not written.
+
+    With verify_md5, the checksum is checked against source + ".md5". The
+    members are written to temporary files and only renamed into place once
+    the whole archive has been read and the checksum matches, so a failed
+    download never replaces files from an earlier one. Raises ValueError if
+    the checksum doesn't match or a member isn't in the archive.
+    """
+    import tarfile
+    from urllib.request import urlopen
+
+    url = resolve_source(source)
+    expected_md5 = read_md5(url) if verify_md5 else None
+    Path.mkdir(Path(out_dir), exist_ok=True, parents=True)
+    members = set(members)
+    extracted = {}
+
+    logger.info(f"Fetching {url}")
+    try:
+        with urlopen(url) as response:
+            reader = _HashingReader(response)
+            with tarfile.open(fileobj=reader, mode="r|gz") as tar:
+                for member in tar:
+                    name = Path(member.name).name
+                    if not member.isfile() or name not in members:
+                        continue
+                    if name in extracted:
+                        raise ValueError(f"{url} has more than one {name}")
+                    logger.info(f"Extracting {name} ({member.size} bytes)")
+                    tmp_file = Path(out_dir, f"{name}.{os.getpid()}.tmp")
+                    extracted[name] = tmp_file
+                    with tar.extractfile(member) as src, open(tmp_file, "wb") as dst:
+                        shutil.copyfileobj(src, dst, READ_BLOCK_SIZE)
+            # The end of the archive and the gzip trailer come after the last
+            # member, and have to be hashed too.
+            reader.drain()
+        logger.info(f"Read {reader.bytes_read} bytes from {url}")
+
+        md5 = reader.md5.hexdigest()
+        if expected_md5 is not None and md5 != expected_md5:
+            raise ValueError(f"MD5 of {url} is {md5}, expected {expected_md5}")
+        missing = sorted(members.difference(extracted))
+        if missing:
+            raise ValueError(f"{url} doesn't contain {', '.join(missing)}")
+
+        for name, tmp_file in extracted.items():
+            os.replace(tmp_file, Path(out_dir, name))
+    finally:
+        for tmp_file in extracted.values():
+            tmp_file.unlink(missing_ok=True)
+    return md5
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Stream a tar.gz archive and extract some of its members"
+    )
+
+    parser.add_argument(
+        "--source",
+        help=("""
+            URL of the archive (http, https, ftp or file), or a local
+            directory that mirrors it
+            """),
+        default=TAXDUMP_URL,
+    )
+    parser.add_argument(
+        "--out_dir", help="Directory to extract the members to", type=Path
+    )
+    parser.add_argument(
+        "--members",
+        help="Names of the members to extract",
+        nargs="+",
+        default=list(TAXDUMP_MEMBERS),
+    )
+    parser.add_argument(
+        "--no_verify",
+        help="Don't check the MD5 checksum against the .md5 file",
+        dest="verify_md5",
+        action="store_false",
+    )
+
+    args = parser.parse_args()
+    if args.out_dir is None:
+        parser.error("the following arguments are required: --out_dir")
+    return args
+
+
+def main():
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+    args = parse_arguments()
+    try:
+        fetch_archive(args.source, args.out_dir, args.members, args.verify_md5)
+    except (OSError, ValueError) as e:
+        logger.error(e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
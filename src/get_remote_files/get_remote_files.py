@@ -1,17 +1,11 @@
 #!/usr/bin/env python3
 
 
+from atol_reference_data_lookups import logger
+from get_remote_files.fetch import TAXDUMP_MEMBERS, TAXDUMP_URL
 from importlib import resources
 from importlib.metadata import metadata
 from pathlib import Path
-from snakemake.api import (
-    SnakemakeApi,
-    ConfigSettings,
-    ResourceSettings,
-    OutputSettings,
-    ExecutionSettings,
-)
-from snakemake.logging import logger
 import argparse
 
 
@@ -24,7 +18,37 @@ def parse_arguments():
         "--parallel_downloads", type=int, help="Number of parallel downloads", default=1
     )
 
-    return parser.parse_args()
+    parser.add_argument(
+        "--taxdump_url",
+        help=(
+            """
+            URL of new_taxdump.tar.gz, or a local directory that mirrors it.
+            The MD5 checksum is read from the same place, with .md5 appended.
+            file:// URLs work as well as http, https and ftp.
+            """
+        ),
+        default=TAXDUMP_URL,
+    )
+
+    parser.add_argument(
+        "--taxdump_members",
+        help=(
+            """
+            Files to extract from new_taxdump.tar.gz. The others are skipped
+            while the archive streams, so they never reach the disk. Must
+            include nodes.dmp and names.dmp, which the index bundle is built
+            from.
+            """
+        ),
+        nargs="+",
+        default=list(TAXDUMP_MEMBERS),
+    )
+
+    args = parser.parse_args()
+    for member in ("nodes.dmp", "names.dmp"):
+        if member not in args.taxdump_members:
+            parser.error(f"--taxdump_members must include {member}")
+    return args
 
 
 def main():
@@ -34,14 +58,25 @@ def main():
     pkg_name = pkg_metadata.get("Name")
     pkg_version = pkg_metadata.get("Version")
 
-    logger.warning(f"{pkg_name} version {pkg_version}")
+    logger.info(f"{pkg_name} version {pkg_version}")
 
     args = parse_arguments()
 
+    # The snakemake API is slow to import, so don't import it until the
+    # arguments have been parsed.
+    from snakemake.api import (
+        SnakemakeApi,
+        ConfigSettings,
+        ResourceSettings,
+        OutputSettings,
+        ExecutionSettings,
+    )
+    from snakemake.logging import logger as snakemake_logger
+
     # get the snakefile
     snakefile = Path(resources.files(__package__), "workflow", "Snakefile")
     if snakefile.is_file():
-        logger.debug(f"Using snakefile {snakefile}")
+        snakemake_logger.debug(f"Using snakefile {snakefile}")
     else:
         raise FileNotFoundError("Could not find a Snakefile")
 
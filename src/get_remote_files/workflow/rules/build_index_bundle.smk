@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+# The bundle is read with atol-reference-data-lookups --index, so the lookups
+# don't need the raw taxdump files or a cache of their own.
+index_bundle = "resources/atol_reference_index"
+
+# The bundle needs nodes.dmp and names.dmp. merged.dmp and delnodes.dmp are
+# only used if they are in taxdump_members.
+bundle_taxdump_files = {
+    Path(x).stem: Path("resources/new_taxdump", x).as_posix()
+    for x in ("nodes.dmp", "names.dmp", "merged.dmp", "delnodes.dmp")
+    if x in taxdump_members
+}
+for x in ("nodes", "names"):
+    if x not in bundle_taxdump_files:
+        raise ValueError(f"taxdump_members must include {x}.dmp for the index bundle")
+
+
+rule build_index_bundle:
+    input:
+        **bundle_taxdump_files,
+        placement_file=rules.download_busco_placement_file.output.placement_file,
+    output:
+        bundle=directory(index_bundle),
+    params:
+        taxdump_files=" ".join(
+            f"--{key} {file_path}" for key, file_path in bundle_taxdump_files.items()
+        ),
+    log:
+        "resources/build_index_bundle.log",
+    shadow:
+        "minimal"
+    shell:
+        "atol-reference-data-lookups "
+        "--build-index {output.bundle} "
+        "{params.taxdump_files} "
+        "--taxids_to_busco_dataset_mapping {input.placement_file} "
+        "--cache_dir index_cache "
+        "&> {log}"
@@ -1,58 +1,32 @@
 #!/usr/bin/env python3
 
-taxdump_url = "ftp://ftp.ncbi.nih.gov/pub/taxonomy/new_taxdump/new_taxdump.tar.gz"
+import sys
 
-taxdump_files = [
-    "citations.dmp",
-    "delnodes.dmp",
-    "division.dmp",
-    "excludedfromtype.dmp",
-    "fullnamelineage.dmp",
-    "gencode.dmp",
-    "host.dmp",
-    "images.dmp",
-    "merged.dmp",
-    "names.dmp",
-    "nodes.dmp",
-    "rankedlineage.dmp",
-    "taxidlineage.dmp",
-    "typematerial.dmp",
-    "typeoftype.dmp",
-]
+from get_remote_files.fetch import TAXDUMP_MEMBERS, TAXDUMP_URL
 
+# The archive is streamed and only these members are extracted. taxdump_url
+# can also be a file:// URL or a local directory that mirrors the archive.
+taxdump_url = config.get("taxdump_url") or TAXDUMP_URL
+taxdump_members = config.get("taxdump_members") or list(TAXDUMP_MEMBERS)
 
-rule expand_taxdump:
-    input:
-        taxdump="resources/new_taxdump.tar.gz",
+
+rule fetch_taxdump:
     output:
-        [Path("resources/new_taxdump", x).as_posix() for x in taxdump_files],
+        [Path("resources/new_taxdump", x).as_posix() for x in taxdump_members],
         timestamp="resources/new_taxdump/TIMESTAMP",
     params:
+        source=taxdump_url,
+        members=taxdump_members,
         outdir=subpath(output[0], parent=True),
-    container:
-        "docker://debian:stable-20250113"
-    shell:
-        "mkdir -p {params.outdir} && "
-        "tar -xzf {input.taxdump} -C {params.outdir} && "
-        "printf $(date -Iseconds) > {output.timestamp}"
-
-
-rule download_taxdump_file:
-    output:
-        taxdump=temp("resources/new_taxdump.tar.gz"),
-    params:
-        url=taxdump_url,
-        name=lambda wildcards: Path(taxdump_url).name,
+        python=sys.executable,
     resources:
         runtime=60,
     log:
-        "resources/download_taxdump_file.log",
-    shadow:
-        "minimal"
-    container:
-        "docker://quay.io/biocontainers/gnu-wget:1.18--hb829ee6_10"
+        "resources/fetch_taxdump.log",
     shell:
-        "wget {params.url} -O {params.name} &> {log} && "
-        "wget {params.url}.md5 -O {params.name}.md5 &>> {log} && "
-        "md5sum -c {params.name}.md5 &>> {log} && "
-        "mv {params.name} {output.taxdump}"
+        "{params.python} -m get_remote_files.fetch "
+        "--source {params.source} "
+        "--out_dir {params.outdir} "
+        "--members {params.members} "
+        "&> {log} && "
+        "printf $(date -Iseconds) > {output.timestamp}"